@@ -0,0 +1,369 @@
+#!/usr/bin/python3
+
+# xl_bench - end to end keystroke latency benchmark.
+# Starts a private Xvfb server and an EWMH window manager, opens a set of dummy windows, and runs Xlettuce against them
+# with its own config in a scratch directory.  Hotkeys are typed with XTest, and each one is timed from the moment the
+# keys are sent until the window's frame (or the current desktop) is seen where the hotkey should have put it.
+#
+#   python3 xl_bench.py --wm openbox --windows 1,10,30 --grids 10x4,4x2 --iterations 100
+#
+# Needs Xvfb, the window manager and python-xlib.  Nothing else on the machine is touched - the benchmark
+# display is separate from the desktop you run it from, and any Xlettuce you already have running is left alone.
+
+import argparse, math, os, re, select, shutil, subprocess, sys, tempfile, time
+import Xlib, Xlib.X, Xlib.Xatom, Xlib.display, Xlib.protocol.event
+from Xlib.ext import xtest
+
+here = os.path.dirname( os.path.realpath( __file__ ) )
+sys.path.insert( 0, here )
+import xl_lattice
+from xlettuce import Xlettuce
+
+TRIGGER = 66 # caps lock - the default XLettuce_Key
+CONTROL = 37 # Control_L
+RIGHT = 114
+LEFT = 113
+
+
+def percentile( ordered, p ):
+    '''nearest rank percentile of a sorted list'''
+    if ( not ordered ):
+        return 0.0
+    return ordered[ max( 0, min( len( ordered ), math.ceil( p / 100.0 * len( ordered ) ) ) - 1 ) ]
+
+
+class Bench:
+    '''one benchmark session - an X server, a window manager, dummy windows, and an Xlettuce instance'''
+
+    def __init__( self, args ):
+        self.args = args
+        self.tmp = tempfile.mkdtemp( prefix="xl_bench." )
+        self.procs = []
+        self.xlettuce = None
+        self.windows = [] # ( client window, frame window )
+        self.geom = {} # frame id -> ( x, y, width, height ), kept current from ConfigureNotify
+        self.desktop = 0
+
+    ####################################################################### setup
+
+    def start_server( self ):
+        displaynum = self.args.display
+        if ( displaynum is None ):
+            displaynum = 90
+            while ( os.path.exists( "/tmp/.X11-unix/X%d" % displaynum ) or os.path.exists( "/tmp/.X%d-lock" % displaynum ) ):
+                displaynum += 1
+        self.displayname = ":%d" % displaynum
+        self.env = dict( os.environ, DISPLAY=self.displayname )
+
+        self.spawn( [ "Xvfb", self.displayname, "-screen", "0", "%sx24" % self.args.screen, "-nolisten", "tcp" ], "xvfb" )
+        deadline = time.monotonic() + 10
+        while ( True ):
+            try:
+                self.d = Xlib.display.Display( self.displayname )
+                break
+            except Exception:
+                if ( time.monotonic() > deadline ):
+                    raise SystemExit( "Xvfb didn't start - see %s" % os.path.join( self.tmp, "xvfb.log" ) )
+                time.sleep( 0.05 )
+
+        self.root = self.d.screen().root
+        self.atom = dict( ( name, self.d.intern_atom( name ) ) for name in
+                          ( "_NET_ACTIVE_WINDOW", "_NET_CLIENT_LIST", "_NET_CURRENT_DESKTOP", "_NET_SUPPORTING_WM_CHECK", "_NET_WORKAREA" ) )
+        if ( not self.d.has_extension( "XTEST" ) ):
+            raise SystemExit( "the X server has no XTEST extension" )
+        self.root.change_attributes( event_mask = Xlib.X.PropertyChangeMask )
+
+
+    def start_wm( self ):
+        self.spawn( self.args.wm.split(), "wm" )
+        if ( not self.wait_for( lambda: self.get_property( self.atom["_NET_SUPPORTING_WM_CHECK"] ), 10 ) ):
+            raise SystemExit( "the window manager didn't start (or isn't EWMH compliant) - see %s" % os.path.join( self.tmp, "wm.log" ) )
+
+
+    def spawn( self, argv, name, cwd=None ):
+        log = open( os.path.join( self.tmp, name + ".log" ), "w" )
+        proc = subprocess.Popen( argv, env=self.env, cwd=cwd, stdout=log, stderr=subprocess.STDOUT )
+        self.procs.append( proc )
+        return proc
+
+
+    def write_conf( self, gridx, gridy ):
+        '''Xlettuce's own config, with the grid under test and every file it writes kept in the scratch directory'''
+        with open( os.path.join( here, "xlettuce.conf" ) ) as f:
+            text = f.read()
+        settings = { "Mon0_Grid_X": gridx, "Mon0_Grid_Y": gridy, "Log_Level": "WARNING",
+                     "Log_File": os.path.join( self.tmp, "xlettuce.log" ),
+                     "Placement_Cache": os.path.join( self.tmp, "xlettuce.placement" ),
+                     "Session_File": os.path.join( self.tmp, "xlettuce.session" ),
+                     "Stats_File": os.path.join( self.tmp, "xlettuce.stats" ) if self.args.stats else "",
+                     "Stats_Interval": 1 }
+        for key, value in settings.items():
+            text, found = re.subn( r"(?m)^%s\s*=.*$" % re.escape( key ), "%s = %s" % ( key, value ), text )
+            if ( not found ):
+                raise SystemExit( "xlettuce.conf has no %s setting" % key )
+        with open( os.path.join( self.tmp, "xlettuce.conf" ), "w" ) as f:
+            f.write( text )
+
+
+    def start_xlettuce( self, gridx, gridy ):
+        self.stop_xlettuce()
+        self.write_conf( gridx, gridy )
+        # run the class directly rather than the script, so the pidfile check can't find (or kill) a real instance
+        code = "import sys; sys.path.insert( 0, %r ); import xlettuce; xlettuce.Xlettuce()" % here
+        self.xlettuce = self.spawn( [ sys.executable, "-c", code ], "xlettuce", cwd=self.tmp )
+
+        workarea = self.get_property( self.atom["_NET_WORKAREA"] )
+        self.lattice = xl_lattice.Lattice( workarea[0], workarea[1], workarea[2], workarea[3], gridx, gridy )
+
+        # ready once it answers a tile hotkey - aim for a cell the window isn't already on
+        entry = self.windows[0]
+        self.activate( entry )
+        deadline = time.monotonic() + 10
+        while ( time.monotonic() < deadline ):
+            if ( self.xlettuce.poll() is not None ):
+                raise SystemExit( "Xlettuce exited - see %s" % os.path.join( self.tmp, "xlettuce.log" ) )
+            cells = ( 0, 0, 0, 0 ) if self.geom[ entry[1].id ] != self.lattice.cell_rect( 0, 0, 0, 0 ) else ( 1, 0, 1, 0 )
+            if ( self.tile( entry, cells, 0.5 ) is not None ):
+                return
+        raise SystemExit( "Xlettuce isn't responding to hotkeys" )
+
+
+    def stop_xlettuce( self ):
+        if ( self.xlettuce is not None and self.xlettuce.poll() is None ):
+            self.xlettuce.terminate()
+            self.xlettuce.wait()
+        self.xlettuce = None
+
+
+    def set_windows( self, count ):
+        '''open or close dummy windows until there are count of them, and wait for the WM to manage them'''
+        while ( len( self.windows ) > count ):
+            window, frame = self.windows.pop()
+            window.destroy()
+        new = []
+        for n in range( len( self.windows ), count ):
+            window = self.root.create_window( 20 * n % 400, 20 * n % 300, 300, 200, 0, self.d.screen().root_depth,
+                                              background_pixel = self.d.screen().white_pixel, event_mask = Xlib.X.StructureNotifyMask )
+            window.set_wm_name( "xl_bench %d" % n )
+            window.set_wm_class( "xl_bench", "XLBench" )
+            window.map()
+            new.append( window )
+        self.d.flush()
+
+        ids = set( w.id for w in new )
+        if ( not self.wait_for( lambda: ids.issubset( self.get_property( self.atom["_NET_CLIENT_LIST"] ) or () ), 10 ) ):
+            raise SystemExit( "the window manager didn't manage the dummy windows" )
+
+        for window in new:
+            frame = window
+            parent = window.query_tree().parent
+            while ( parent.id != self.root.id ):
+                frame = parent
+                parent = frame.query_tree().parent
+            frame.change_attributes( event_mask = Xlib.X.StructureNotifyMask )
+            g = frame.get_geometry()
+            self.geom[ frame.id ] = ( g.x, g.y, g.width, g.height )
+            self.windows.append( ( window, frame ) )
+
+    ####################################################################### X helpers
+
+    def get_property( self, atom ):
+        prop = self.root.get_full_property( atom, Xlib.X.AnyPropertyType )
+        return list( prop.value ) if prop else None
+
+
+    def pump( self, timeout ):
+        '''read X events for up to timeout seconds, keeping frame geometry and the current desktop up to date'''
+        if ( not self.d.pending_events() ):
+            select.select( [ self.d.fileno() ], [], [], max( 0, timeout ) )
+        while ( self.d.pending_events() ):
+            event = self.d.next_event()
+            if ( event.type == Xlib.X.ConfigureNotify and event.window.id in self.geom ):
+                self.geom[ event.window.id ] = ( event.x, event.y, event.width, event.height )
+            elif ( event.type == Xlib.X.PropertyNotify and event.atom == self.atom["_NET_CURRENT_DESKTOP"] ):
+                self.desktop = ( self.get_property( self.atom["_NET_CURRENT_DESKTOP"] ) or [0] )[0]
+
+
+    def wait_for( self, condition, timeout ):
+        '''pump events until condition() is true.  Returns the time it took, or None on timeout.'''
+        start = time.perf_counter()
+        deadline = start + timeout
+        while ( not condition() ):
+            now = time.perf_counter()
+            if ( now > deadline ):
+                return None
+            self.pump( min( 0.05, deadline - now ) )
+        return time.perf_counter() - start
+
+
+    def keys( self, *codes ):
+        '''type a hotkey: trigger down, then each key (a list is a chord - pressed in order, released in reverse), trigger up'''
+        xtest.fake_input( self.d, Xlib.X.KeyPress, TRIGGER )
+        for code in codes:
+            chord = code if isinstance( code, ( list, tuple ) ) else [ code ]
+            for c in chord:
+                xtest.fake_input( self.d, Xlib.X.KeyPress, c )
+            for c in reversed( chord ):
+                xtest.fake_input( self.d, Xlib.X.KeyRelease, c )
+        xtest.fake_input( self.d, Xlib.X.KeyRelease, TRIGGER )
+        self.d.flush()
+
+
+    def activate( self, entry ):
+        window, frame = entry
+        ev = Xlib.protocol.event.ClientMessage( window=window, client_type=self.atom["_NET_ACTIVE_WINDOW"], data=( 32, [ 2, 0, 0, 0, 0 ] ) )
+        self.root.send_event( ev, event_mask = Xlib.X.SubstructureRedirectMask | Xlib.X.SubstructureNotifyMask )
+        self.d.flush()
+        self.wait_for( lambda: ( self.get_property( self.atom["_NET_ACTIVE_WINDOW"] ) or [0] )[0] == window.id, 2 )
+
+    ####################################################################### hotkeys
+
+    def tilekeys( self, cells ):
+        '''keycodes for the top left and bottom right cells'''
+        keys = dict( ( xy, code ) for code, xy in Xlettuce.tilekeymap.items() )
+        return ( keys[ cells[0:2] ], keys[ cells[2:4] ] )
+
+
+    def timed( self, frame, expected, timeout, send ):
+        start = time.perf_counter()
+        send()
+        taken = self.wait_for( lambda: self.geom[ frame.id ] == expected, timeout )
+        return None if taken is None else time.perf_counter() - start
+
+
+    def tile( self, entry, cells, timeout ):
+        expected = self.lattice.cell_rect( *cells )
+        return self.timed( entry[1], expected, timeout, lambda: self.keys( *self.tilekeys( cells ) ) )
+
+
+    def move( self, entry, steps, timeout ):
+        x, y, width, height = self.geom[ entry[1].id ]
+        expected = ( self.lattice.move( 'x', x, steps ), y, width, height )
+        return self.timed( entry[1], expected, timeout, lambda: self.keys( RIGHT if steps > 0 else LEFT ) )
+
+
+    def resize( self, entry, steps, timeout ):
+        x, y, width, height = self.geom[ entry[1].id ]
+        expected = ( x, y, self.lattice.resize_end( 'x', x, x + width, steps ) - x, height )
+        return self.timed( entry[1], expected, timeout, lambda: self.keys( [ CONTROL, RIGHT if steps > 0 else LEFT ] ) )
+
+
+    def switch_desktop( self, desktop, timeout ):
+        keys = dict( ( d, code ) for code, d in Xlettuce.desktopkeymap.items() )
+        start = time.perf_counter()
+        self.keys( keys[ desktop ] )
+        taken = self.wait_for( lambda: self.desktop == desktop, timeout )
+        return None if taken is None else time.perf_counter() - start
+
+    ####################################################################### scenarios
+
+    def run_action( self, action ):
+        '''time iterations of one hotkey, alternating between two targets so every press changes something'''
+        entry = self.windows[-1]
+        self.activate( entry )
+        timeout = self.args.timeout
+        gx, gy = self.lattice.gridX, self.lattice.gridY
+        small = ( 0, 0, min( 1, gx - 1 ), min( 1, gy - 1 ) )
+        other = ( gx // 2, gy // 2, gx - 1, gy - 1 )
+
+        if ( action in ( "move", "resize" ) ):
+            self.tile( entry, small, timeout )
+
+        times = []
+        failures = 0
+        for i in range( self.args.warmup + self.args.iterations ):
+            if ( action == "tile" ):
+                taken = self.tile( entry, other if i % 2 else small, timeout )
+            elif ( action == "move" ):
+                taken = self.move( entry, -1 if i % 2 else 1, timeout )
+            elif ( action == "resize" ):
+                taken = self.resize( entry, -1 if i % 2 else 1, timeout )
+            else:
+                taken = self.switch_desktop( 0 if i % 2 else 1, timeout )
+
+            if ( i < self.args.warmup ):
+                continue
+            if ( taken is None ):
+                failures += 1
+            else:
+                times.append( taken )
+
+        if ( action == "desktop" and self.desktop != 0 ):
+            self.switch_desktop( 0, timeout )
+
+        times.sort()
+        return times, failures
+
+
+    def run( self ):
+        print( "%-7s %6s %8s %6s %6s %9s %9s %9s %9s %10s" % ( "grid", "wins", "action", "ok", "fail", "p50 ms", "p95 ms", "p99 ms", "max ms", "ops/s" ) )
+        self.start_server()
+        self.start_wm()
+        self.set_windows( 1 )
+
+        for grid in self.args.grids.split( "," ):
+            gridx, gridy = [ int( v ) for v in grid.lower().split( "x" ) ]
+            for count in [ int( v ) for v in self.args.windows.split( "," ) ]:
+                self.set_windows( max( 1, count ) )
+                self.start_xlettuce( gridx, gridy )
+                for action in self.args.actions.split( "," ):
+                    times, failures = self.run_action( action )
+                    total = sum( times )
+                    print( "%-7s %6d %8s %6d %6d %9.3f %9.3f %9.3f %9.3f %10.1f" % ( grid, count, action, len( times ), failures,
+                           1000 * percentile( times, 50 ), 1000 * percentile( times, 95 ), 1000 * percentile( times, 99 ),
+                           1000 * ( times[-1] if times else 0 ), len( times ) / total if total else 0 ) )
+                    sys.stdout.flush()
+
+                if ( self.args.stats ):
+                    self.print_stats()
+
+
+    def print_stats( self ):
+        '''show the stats Xlettuce wrote about itself - its side of the same presses, without the X server and WM'''
+        time.sleep( 1.5 ) # Stats_Interval is 1 second
+        try:
+            with open( os.path.join( self.tmp, "xlettuce.stats" ) ) as f:
+                print( "\n" + "".join( "    " + line for line in f ) )
+        except EnvironmentError:
+            print( "\n    (no stats written)\n" )
+
+
+    def close( self ):
+        self.stop_xlettuce()
+        for proc in reversed( self.procs ):
+            if ( proc.poll() is None ):
+                proc.terminate()
+                try:
+                    proc.wait( 5 )
+                except subprocess.TimeoutExpired:
+                    proc.kill()
+        if ( self.args.keep ):
+            print( "logs kept in %s" % self.tmp )
+        else:
+            shutil.rmtree( self.tmp, ignore_errors=True )
+
+
+def main():
+    parser = argparse.ArgumentParser( description="Xlettuce keystroke latency benchmark - runs under its own Xvfb server" )
+    parser.add_argument( "--wm", default="openbox", help="window manager command line (default: openbox)" )
+    parser.add_argument( "--windows", default="1,10,30", help="comma separated dummy window counts (default: 1,10,30)" )
+    parser.add_argument( "--grids", default="10x4", help="comma separated grid sizes, COLSxROWS (default: 10x4)" )
+    parser.add_argument( "--actions", default="tile,move,resize,desktop", help="hotkeys to time (default: tile,move,resize,desktop)" )
+    parser.add_argument( "--iterations", type=int, default=100, help="timed presses per action (default: 100)" )
+    parser.add_argument( "--warmup", type=int, default=5, help="untimed presses before each action (default: 5)" )
+    parser.add_argument( "--timeout", type=float, default=1.0, help="seconds to wait for each press to take effect (default: 1)" )
+    parser.add_argument( "--screen", default="1920x1080", help="Xvfb screen size (default: 1920x1080)" )
+    parser.add_argument( "--display", type=int, default=None, help="display number for Xvfb (default: first free from :90)" )
+    parser.add_argument( "--stats", action="store_true", help="also have Xlettuce write its own latency stats" )
+    parser.add_argument( "--keep", action="store_true", help="keep the scratch directory with the logs" )
+    args = parser.parse_args()
+
+    bench = Bench( args )
+    try:
+        bench.run()
+    finally:
+        bench.close()
+
+
+if __name__ == "__main__":
+    main()
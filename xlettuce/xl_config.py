@@ -2,27 +2,75 @@
 
 # config file loading, parsing, saving functions
 
-import configparser, weakref
-from collections import OrderedDict
+import configparser, weakref, types, shlex, os, marshal
+from collections import OrderedDict, namedtuple
+
+
+def parse_bool( value ):
+    '''bool() is True for any non-empty string, including "False" - parse the text instead'''
+    if ( isinstance( value, bool ) ):
+        return value
+    return str( value ).strip().lower() in ( "true", "yes", "on", "1" )
+
+
+# characters that only mean what they say when a shell runs the command - pipes, redirection, variables, globs, etc
+shellchars = frozenset( "|&;<>()$`*?[]{}\n" )
+
+def parse_command( command ):
+    '''
+    Split a command line into an argv tuple, once, so launching it needs no parsing.  ~ is expanded in each argument.
+    Commands that use shell features are run as ( "/bin/sh", "-c", command ) instead.  Blank commands are None.
+    '''
+    if ( not command ):
+        return None
+    if ( shellchars.intersection( command ) ):
+        return ( "/bin/sh", "-c", command )
+    try:
+        argv = shlex.split( command )
+    except ValueError:
+        return ( "/bin/sh", "-c", command ) # unbalanced quotes - let the shell report it
+    return tuple( os.path.expanduser( arg ) for arg in argv ) or None
+
+
+# immutable, typed view of the settings - built once by read_values(), read by the hot paths instead of get()
+Snapshot = namedtuple( 'Snapshot', 'general launchers hud monitors sessions' )
+General = namedtuple( 'General', 'trigger_key alternate_key displays log_level log_file log_overwrite placement_cache stats_file stats_interval count_requests round_trip_budget startup_budget control_socket' )
+Hud = namedtuple( 'Hud', 'start_hidden apps' )
+HudApp = namedtuple( 'HudApp', 'command wmclass hotkey pos_x pos_y width height' )
+Monitor = namedtuple( 'Monitor', 'hotkey grid_x grid_y weights_x weights_y' )
+Sessions = namedtuple( 'Sessions', 'file save_hotkey restore_hotkey' )
+
 
 class xl_config:
     configfile = "./xlettuce.conf"
+    cachefile = "./xlettuce.conf.cache" # parsed values of configfile, so startup can skip parsing when it hasn't changed
     
     parsefunctions = {
             "STR":str,
             "INT":int,
-            "BOOL":bool,
+            "BOOL":parse_bool,
             "FLOAT":float
     }
+
+    # largest grid the tiling hotkeys can address - 10 columns x 4 rows of keys
+    max_grid_x = 10
+    max_grid_y = 4
     
     parser = configparser.ConfigParser( dict_type=OrderedDict, allow_no_value=True , inline_comment_prefixes=("#",) )
     
+    @staticmethod
+    def new_parser():
+        return configparser.ConfigParser( dict_type=OrderedDict, allow_no_value=True , inline_comment_prefixes=("#",) )
+    
     def __init__(self, parent):
         self.parent = weakref.proxy(parent)
         self.settings_read=False # set to true once a settings file has been read into self.key
         self.read_key()
-        self.load_file()
-        self.read_values()
+        stamp = self.cache_stamp()
+        if ( stamp is None or not self.load_cache( stamp ) ):
+            self.load_file()
+            self.read_values()
+            self.save_cache( stamp or self.cache_stamp() )
             
     def read_key(self):
         # store key to the config file
@@ -39,9 +87,17 @@ class xl_config:
         key['GENERAL'] = OrderedDict()
         key['GENERAL']['XLettuce_Key'] =  [ 'INT', 66, True, "Keycode of the key you want dedicated to activating Xlettuce.  [eg: capslock=66, scroll lock=78, pause/break=127]", "" ]
         key['GENERAL']['Alternate_Key'] =  [ 'INT', 0, True, "Optional - if you want a second activation key, enter the keycode here.]", "" ]
+        key['GENERAL']['Displays'] =  [ 'STR', "", True, "Optional - X displays and screens to manage from this one process, comma separated [eg: :0.0, :0.1, :1].  Blank for $DISPLAY", "" ]
         key['GENERAL']['Log_Level'] =  [ 'STR', "DEBUG", True, "DEBUG, INFO, WARNING, ERROR, CRITICAL", "" ]
         key['GENERAL']['Log_File'] =  [ 'STR', "./xlettuce.log", True, "Path to log file", "" ]
         key['GENERAL']['Log_Overwrite'] =  [ 'BOOL', True, True, "Overwrite log file every session?  True/False", "" ]
+        key['GENERAL']['Placement_Cache'] =  [ 'STR', "./xlettuce.placement", True, "Where to remember how each application's windows need to be placed", "" ]
+        key['GENERAL']['Stats_File'] =  [ 'STR', "", True, "Optional - write hotkey latency statistics to this file.  Blank to turn stats off.", "" ]
+        key['GENERAL']['Stats_Interval'] =  [ 'INT', 10, True, "How often to write the stats file, in seconds", "" ]
+        key['GENERAL']['Count_Requests'] =  [ 'BOOL', False, True, "Count the X requests and round trips each hotkey makes - logged at DEBUG, and added to the stats file", "" ]
+        key['GENERAL']['Round_Trip_Budget'] =  [ 'INT', 0, True, "With Count_Requests on, log a warning when a hotkey waits on the X server more times than this.  0 for no limit", "" ]
+        key['GENERAL']['Startup_Budget'] =  [ 'INT', 200, True, "Log a warning if startup takes longer than this many milliseconds (run xlettuce.py --startup-trace for a breakdown).  0 for no limit", "" ]
+        key['GENERAL']['Control_Socket'] =  [ 'STR', "auto", True, "Unix socket xlettuce-ctl and scripts control Xlettuce through.  auto for one in $XDG_RUNTIME_DIR, a path, or off", "" ]
         
         ########################### LAUNCHERS
         key['LAUNCHERS'] = OrderedDict()
@@ -84,9 +140,14 @@ class xl_config:
         key['HUD']['comment2'] = "# XLettuce_Key+HUD_Hotkey makes the app appear and disappear above your other windows, in the same location every time."
         key['HUD']['comment3'] = "# Ideal for utility apps you use all the time - terminals, txt editor, file manager, etc."
         key['HUD']['comment4'] = "# COMMAND - Command to open your App.  Can accept BASH arguments."
-        key['HUD']['comment5'] = "# HOTKEY - Keycode of the key you want to press (+ XLettuce Key) to launch, show, and hide this HUD App."
+        key['HUD']['comment5'] = "# CLASS - WM_CLASS (instance or class) of the App's window.  The window is found by the pid COMMAND starts, so set this if COMMAND doesn't run the App itself - eg: a shell pipeline, or an App that hands off to an already running copy."
+        key['HUD']['comment6'] = "# HOTKEY - Keycode of the key you want to press (+ XLettuce Key) to launch, show, and hide this HUD App."
+        key['HUD']['comment7'] = "# POSX/POSY/WIDTH/HEIGHT - where the app appears, in pixels.  Leave them blank to use the top half of the primary monitor."
+        key['HUD']['comment8'] = "# START_HIDDEN - start every HUD app when XLettuce starts, hidden, so the first press of its hotkey shows it instantly."
+        key['HUD']['Start_Hidden'] = [ 'BOOL', False, True, "", "" ]
     
         key['HUD']['App1_Command'] = [ 'STR', "", True, "", "" ]
+        key['HUD']['App1_Class'] = [ 'STR', "", True, "", "" ]
         key['HUD']['App1_Hotkey'] = [ 'INT', "", True, "", "" ]
         key['HUD']['App1_PosX'] = [ 'INT', "", True, "", "" ]
         key['HUD']['App1_PosY'] = [ 'INT', "", True, "", "" ]
@@ -94,6 +155,7 @@ class xl_config:
         key['HUD']['App1_Height'] = [ 'INT', "", True, "", "" ]
     
         key['HUD']['App2_Command'] = [ 'STR', "", True, "", "" ]
+        key['HUD']['App2_Class'] = [ 'STR', "", True, "", "" ]
         key['HUD']['App2_Hotkey'] = [ 'INT', "", True, "", "" ]
         key['HUD']['App2_PosX'] = [ 'INT', "", True, "", "" ]
         key['HUD']['App2_PosY'] = [ 'INT', "", True, "", "" ]
@@ -101,6 +163,7 @@ class xl_config:
         key['HUD']['App2_Height'] = [ 'INT', "", True, "", "" ]
     
         key['HUD']['App3_Command'] = [ 'STR', "", True, "", "" ]
+        key['HUD']['App3_Class'] = [ 'STR', "", True, "", "" ]
         key['HUD']['App3_Hotkey'] = [ 'INT', "", True, "", "" ]
         key['HUD']['App3_PosX'] = [ 'INT', "", True, "", "" ]
         key['HUD']['App3_PosY'] = [ 'INT', "", True, "", "" ]
@@ -108,6 +171,7 @@ class xl_config:
         key['HUD']['App3_Height'] = [ 'INT', "", True, "", "" ]
     
         key['HUD']['App4_Command'] = [ 'STR', "", True, "", "" ]
+        key['HUD']['App4_Class'] = [ 'STR', "", True, "", "" ]
         key['HUD']['App4_Hotkey'] = [ 'INT', "", True, "", "" ]
         key['HUD']['App4_PosX'] = [ 'INT', "", True, "", "" ]
         key['HUD']['App4_PosY'] = [ 'INT', "", True, "", "" ]
@@ -137,6 +201,25 @@ class xl_config:
         
         key['MONITORS']['Mon3_Grid_X'] =  [ 'INT', 6, True, "", "" ]
         key['MONITORS']['Mon3_Grid_Y'] =  [ 'INT', 4, True, "", "" ]
+
+        key['MONITORS']['comment4'] = "# Optional column/row weights, one per grid column/row, eg: Mon0_Weights_X = 1,2,1 makes the middle of 3 columns twice as wide."
+        key['MONITORS']['comment5'] = "# Leave blank for equal sized cells."
+        key['MONITORS']['Mon0_Weights_X'] =  [ 'STR', "", True, "", "" ]
+        key['MONITORS']['Mon0_Weights_Y'] =  [ 'STR', "", True, "", "" ]
+        key['MONITORS']['Mon1_Weights_X'] =  [ 'STR', "", True, "", "" ]
+        key['MONITORS']['Mon1_Weights_Y'] =  [ 'STR', "", True, "", "" ]
+        key['MONITORS']['Mon2_Weights_X'] =  [ 'STR', "", True, "", "" ]
+        key['MONITORS']['Mon2_Weights_Y'] =  [ 'STR', "", True, "", "" ]
+        key['MONITORS']['Mon3_Weights_X'] =  [ 'STR', "", True, "", "" ]
+        key['MONITORS']['Mon3_Weights_Y'] =  [ 'STR', "", True, "", "" ]
+        
+        ########################### SESSIONS
+        key['SESSIONS'] = OrderedDict()
+        key['SESSIONS']['comment'] = "# Save the layout of all open windows (desktop, monitor, grid position), and put them back later."
+        key['SESSIONS']['comment2'] = "# XLettuce_Key + CTRL + Save_Hotkey saves the session, XLettuce_Key + CTRL + Restore_Hotkey restores it."
+        key['SESSIONS']['Session_File'] =  [ 'STR', "./xlettuce.session", True, "", "" ]
+        key['SESSIONS']['Save_Hotkey'] =  [ 'INT', 39, True, "Keycode - default is S", "" ]
+        key['SESSIONS']['Restore_Hotkey'] =  [ 'INT', 27, True, "Keycode - default is R", "" ]
         
         self.key=key
         return key
@@ -190,6 +273,71 @@ class xl_config:
         self.parser.read_file( f )
            
             
+    def reload(self):
+        '''
+        Re-read the config file into a fresh parser and key, and swap them in once parsing has succeeded.
+        Returns the new Snapshot, or None if the file couldn't be read - the current settings stay in place in that case.
+        '''
+        parser = self.new_parser()
+        try:
+            with open( self.configfile ) as f:
+                parser.read_file( f )
+        except ( EnvironmentError, configparser.Error ) as err:
+            print("config: reload failed, keeping current settings: %s" % err)
+            return None
+
+        self.parser = parser
+        self.read_key()
+        self.read_values()
+        self.save_cache( self.cache_stamp() )
+        return self.snap
+
+
+    def cache_stamp(self):
+        '''what the parsed value cache is keyed on - the config file's mtime and size, and this module's mtime, so a new
+        version that adds or changes settings doesn't read an old cache.  None if the config file doesn't exist yet.'''
+        try:
+            conf = os.stat( self.configfile )
+            code = os.stat( __file__ )
+        except EnvironmentError:
+            return None
+        return [ conf.st_mtime_ns, conf.st_size, code.st_mtime_ns ]
+
+
+    def load_cache(self, stamp):
+        '''fill in self.key's values from the cache, if it was written for this version of the config file.  Returns True if it was.'''
+        try:
+            with open( self.cachefile, 'rb' ) as f:
+                cached = marshal.load( f )
+            if ( cached['stamp'] != stamp ):
+                return False
+            values = cached['values']
+            for section in self.key:
+                for name in self.key[section]:
+                    if ( name.find("comment", 0, 7) != 0 ):
+                        self.key[section][name][4] = values[section][name]
+        except ( EnvironmentError, EOFError, ValueError, TypeError, KeyError ):
+            return False
+
+        self.settings_read=True
+        self.snap = self.make_snapshot()
+        return True
+
+
+    def save_cache(self, stamp):
+        if ( stamp is None ):
+            return
+        values = {}
+        for section in self.key:
+            values[section] = { name: item[4] for name, item in self.key[section].items() if name.find("comment", 0, 7) != 0 }
+        try:
+            with open( self.cachefile + ".tmp", 'wb' ) as f:
+                marshal.dump( { 'stamp': stamp, 'values': values }, f )
+            os.replace( self.cachefile + ".tmp", self.cachefile )
+        except EnvironmentError as err:
+            print("config: couldn't write %s: %s" % ( self.cachefile, err ))
+
+
     def make_file(self):
         '''Writes a new, blank xlettuce config file with default values'''
         confstr=self.generate_conf_string(True)
@@ -231,12 +379,87 @@ class xl_config:
                     value = self.parser.get(section, name)
                     
                 #parse for type, assign
-                if (value):
-                    item[4] = self.parsefunctions[item[0]](value)
-                else:
-                    item[4] = ""
+                try:
+                    item[4] = self.parsefunctions[item[0]](value) if (value) else ""
+                except ValueError:
+                    print("config: [%s] %s = %s is not a valid %s - using default: %s" % ( section, name, value, item[0], item[1] ))
+                    item[4] = item[1]
                     
         self.settings_read=True
+        self.snap = self.make_snapshot()
+
+
+    def make_snapshot(self):
+        '''build the immutable, typed settings Snapshot from self.key.  Values are validated here, once, rather than on every read.
+        Blank values are None.'''
+
+        def val(section, option):
+            value = self.key[section][option][4]
+            return None if value == "" else value
+
+        def grid(section, option, maximum):
+            value = val(section, option)
+            if ( value is None or not 1 <= value <= maximum ):
+                print("config: [%s] %s must be between 1 and %d - using default: %s" % ( section, option, maximum, self.key[section][option][1] ))
+                value = self.key[section][option][1]
+            return value
+
+        def weights(section, option, count):
+            # comma separated list of positive numbers, one per grid column/row
+            value = val(section, option)
+            if ( value is None ):
+                return None
+            try:
+                parsed = tuple( float(w) for w in value.split(",") )
+            except ValueError:
+                parsed = ()
+            if ( len(parsed) != count or min(parsed) <= 0 ):
+                print("config: [%s] %s needs %d positive numbers - using equal sized cells" % ( section, option, count ))
+                return None
+            return parsed
+
+        general = General( trigger_key = val("GENERAL", "XLettuce_Key"),
+                           alternate_key = val("GENERAL", "Alternate_Key"),
+                           displays = tuple( name.strip() for name in ( val("GENERAL", "Displays") or "" ).split(",") if name.strip() ) or ( None, ),
+                           log_level = val("GENERAL", "Log_Level"),
+                           log_file = val("GENERAL", "Log_File"),
+                           log_overwrite = val("GENERAL", "Log_Overwrite"),
+                           placement_cache = val("GENERAL", "Placement_Cache"),
+                           stats_file = val("GENERAL", "Stats_File"),
+                           stats_interval = max( 1, val("GENERAL", "Stats_Interval") or 10 ),
+                           count_requests = val("GENERAL", "Count_Requests"),
+                           round_trip_budget = val("GENERAL", "Round_Trip_Budget") or 0,
+                           startup_budget = val("GENERAL", "Startup_Budget") or 0,
+                           control_socket = val("GENERAL", "Control_Socket") )
+
+        # launcher name ( "f1", "SHIFT+f1", ... ) -> argv tuple, or None if the launcher isn't set
+        launchers = types.MappingProxyType( OrderedDict( ( name, parse_command( val("LAUNCHERS", name) ) ) for name in self.key['LAUNCHERS'] if name.find("comment", 0, 7) != 0 ) )
+
+        apps = tuple( HudApp( command = parse_command( val("HUD", "App%d_Command" % n) ),
+                              wmclass = ( val("HUD", "App%d_Class" % n) or "" ).lower(),
+                              hotkey = val("HUD", "App%d_Hotkey" % n),
+                              pos_x = val("HUD", "App%d_PosX" % n),
+                              pos_y = val("HUD", "App%d_PosY" % n),
+                              width = val("HUD", "App%d_Width" % n),
+                              height = val("HUD", "App%d_Height" % n) ) for n in range(1, 5) )
+        hud = Hud( start_hidden = val("HUD", "Start_Hidden"), apps = apps )
+
+        monitors = []
+        for n in range(4):
+            grid_x = grid("MONITORS", "Mon%d_Grid_X" % n, self.max_grid_x)
+            grid_y = grid("MONITORS", "Mon%d_Grid_Y" % n, self.max_grid_y)
+            monitors.append( Monitor( hotkey = val("MONITORS", "Mon%d_Hotkey" % n),
+                                      grid_x = grid_x,
+                                      grid_y = grid_y,
+                                      weights_x = weights("MONITORS", "Mon%d_Weights_X" % n, grid_x),
+                                      weights_y = weights("MONITORS", "Mon%d_Weights_Y" % n, grid_y) ) )
+        monitors = tuple( monitors )
+
+        sessions = Sessions( file = val("SESSIONS", "Session_File"),
+                             save_hotkey = val("SESSIONS", "Save_Hotkey"),
+                             restore_hotkey = val("SESSIONS", "Restore_Hotkey") )
+
+        return Snapshot( general=general, launchers=launchers, hud=hud, monitors=monitors, sessions=sessions )
     
     
     def get(self, section, option):
@@ -0,0 +1,407 @@
+#!/usr/bin/python3
+
+# xl_control - local control socket.
+# Xlettuce listens on a Unix domain socket so scripts can tile, move and resize windows, switch desktops, save and
+# restore sessions and query state without going through the keyboard.  The socket is serviced by the main event loop,
+# like the X connection - nothing blocks, and a client can keep one connection open and pipeline commands.
+#
+# The protocol is one command per line, with one reply line per command, in order:
+#   ok [json]        the command ran - queries return their result as json
+#   err <message>    it didn't
+# Window commands act on the active window, or on a given window if the first argument is @<window id>, eg:
+#   tile @0x3a00007 0 0 4 3
+# With several screens, "screen N" picks the one a connection's commands go to - otherwise it's the last one a hotkey was used on.
+# See help() for the command list - xlettuce-ctl is a small command line client.
+
+import socket, os, stat, json, errno, time, weakref
+import Xlib, Xlib.error
+import logging
+logger = logging.getLogger(__name__)
+
+
+# direction name -> cursor keycode, for the commands that reuse the cursor key handlers
+directions = { "up": 111, "left": 113, "right": 114, "down": 116 }
+
+
+def default_path():
+    '''where the socket goes when Control_Socket is "auto" - one per X display, in the user's runtime directory'''
+    directory = os.environ.get( "XDG_RUNTIME_DIR" ) or "/tmp"
+    display = os.environ.get( "DISPLAY", ":0" ).replace( "/", "_" )
+    return os.path.join( directory, "xlettuce%s.%d.sock" % ( display, os.getuid() ) )
+
+
+def socket_path( setting ):
+    '''the socket path for a Control_Socket setting - None if the control socket is turned off'''
+    if ( not setting or setting.lower() == "off" ):
+        return None
+    if ( setting.lower() == "auto" ):
+        return default_path()
+    return os.path.expanduser( setting )
+
+
+class CommandError( Exception ):
+    '''a command that can't be run - the message is sent back to the client'''
+
+
+class Connection:
+    '''one client connection - incoming bytes are split into lines, and replies are queued until the socket takes them'''
+
+    maxline = 65536 # a client sending a longer line than this is dropped
+
+    def __init__( self, server, sock ):
+        self.server = server
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.inbuf = b""
+        self.outbuf = bytearray()
+        self.writing = False
+        self.screen = None # screen chosen with the screen command - None to follow the keyboard
+        server.loop.add_reader( self.fd, self.read )
+
+
+    def read( self ):
+        try:
+            data = self.sock.recv( 65536 )
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+        if ( not data ):
+            self.close()
+            return
+
+        lines = ( self.inbuf + data ).split( b"\n" )
+        self.inbuf = lines.pop()
+        if ( len( self.inbuf ) > self.maxline ):
+            logger.warning("control: dropping client - line too long")
+            self.close()
+            return
+
+        # run every complete line, then send the replies together - a pipelined batch costs one write, not one per command
+        for line in lines:
+            self.outbuf += self.server.run( line.decode( "utf-8", "replace" ), self ).encode( "utf-8" ) + b"\n"
+        for screen in self.server.parent.screens:
+            screen.display.flush()
+        self.write()
+
+
+    def write( self ):
+        try:
+            sent = self.sock.send( self.outbuf )
+        except BlockingIOError:
+            sent = 0
+        except OSError:
+            self.close()
+            return
+        del self.outbuf[:sent]
+
+        # wait for the socket to drain if the client isn't reading its replies as fast as they're produced
+        if ( self.outbuf and not self.writing ):
+            self.server.loop.add_writer( self.fd, self.write )
+            self.writing = True
+        elif ( not self.outbuf and self.writing ):
+            self.server.loop.remove_writer( self.fd )
+            self.writing = False
+
+
+    def close( self ):
+        self.server.loop.remove_writer( self.fd )
+        self.server.loop.remove_reader( self.fd )
+        self.sock.close()
+        self.server.connections.discard( self )
+
+
+class ControlServer:
+    '''listens on the control socket, and runs the commands clients send'''
+
+    def __init__( self, parent, loop, path ):
+        self.parent = weakref.proxy(parent)
+        self.loop = loop
+        self.path = path
+        self.connections = set()
+        self.connection = None # the connection whose command is running
+        self.sock = self.listen( path )
+        if ( self.sock ):
+            self.loop.add_reader( self.sock.fileno(), self.accept )
+            logger.info("control: listening on %s" % path )
+
+
+    def listen( self, path ):
+        # a socket left behind by an Xlettuce that didn't exit cleanly is replaced - one that still answers is not, and
+        # nor is anything at that path that isn't a socket
+        if ( os.path.lexists( path ) ):
+            if ( not stat.S_ISSOCK( os.lstat( path ).st_mode ) ):
+                logger.warning("control: %s exists and isn't a socket - control socket disabled" % path )
+                return None
+            probe = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+            try:
+                probe.connect( path )
+                logger.warning("control: %s is in use by another Xlettuce - control socket disabled" % path )
+                return None
+            except OSError:
+                try:
+                    os.unlink( path )
+                except OSError:
+                    pass # bind fails below, and says why
+            finally:
+                probe.close()
+
+        sock = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+        try:
+            oldmask = os.umask( 0o077 ) # only the user running Xlettuce can connect
+            try:
+                sock.bind( path )
+            finally:
+                os.umask( oldmask )
+            sock.listen( 16 )
+        except OSError as err:
+            logger.warning("control: couldn't listen on %s: %s" % ( path, err ) )
+            sock.close()
+            return None
+        sock.setblocking( False )
+        return sock
+
+
+    def accept( self ):
+        while True:
+            try:
+                sock, address = self.sock.accept()
+            except ( BlockingIOError, InterruptedError ):
+                return
+            except OSError as err:
+                if ( err.errno not in ( errno.EMFILE, errno.ENFILE, errno.ECONNABORTED ) ):
+                    raise
+                logger.warning("control: accept failed: %s" % err )
+                return
+            sock.setblocking( False )
+            self.connections.add( Connection( self, sock ) )
+
+
+    def stop( self ):
+        for connection in list( self.connections ):
+            connection.close()
+        if ( self.sock ):
+            self.loop.remove_reader( self.sock.fileno() )
+            self.sock.close()
+            self.sock = None
+            try:
+                os.unlink( self.path )
+            except OSError:
+                pass
+
+
+    def run( self, line, connection ):
+        '''run one command line from connection, and return its reply line'''
+        args = line.split()
+        if ( not args ):
+            return "err empty command"
+        handler = getattr( self, "cmd_" + args[0].lower(), None )
+        if ( handler is None ):
+            return "err unknown command %s - try help" % args[0]
+
+        if ( connection.screen is not None ):
+            self.parent.use_screen( connection.screen )
+        self.connection = connection
+        start = time.perf_counter()
+        try:
+            result = handler( args[1:] )
+        except CommandError as err:
+            return "err %s" % err
+        except ( ValueError, IndexError ):
+            return "err bad arguments for %s - try help" % args[0]
+        except ( AttributeError, Xlib.error.XError ) as err:
+            # same as a hotkey - the window went away while we were working on it
+            logger.debug("control: %s failed: %s" % ( line, err ) )
+            return "err %s" % err
+        except Exception as err:
+            # a bug, or arguments Xlib can't pack - one bad line mustn't take Xlettuce down with it
+            logger.exception("control: %s failed" % line )
+            return "err %s: %s" % ( type( err ).__name__, err )
+
+        if ( self.parent.stats ):
+            self.parent.stats.record( "ctl_" + args[0].lower(), time.perf_counter() - start )
+        if ( result is None ):
+            return "ok"
+        return "ok " + json.dumps( result, separators=( ',', ':' ) )
+
+
+    ######## helpers
+
+    def target( self, args ):
+        '''
+        Point the parent's activeWindow and currentMonitor at the window a command acts on - the active window, or the
+        window given as @<id> in args[0], which is then removed from args.  Returns the window.
+        '''
+        parent = self.parent
+        screen = parent.screen
+        if ( args and args[0].startswith( "@" ) ):
+            windowid = int( args.pop( 0 )[1:], 0 )
+            if ( not 0 < windowid <= 0x1FFFFFFF ): # X resource ids are 29 bits
+                raise CommandError( "bad window id %s" % hex( windowid ) )
+            window = parent.display.create_resource_object( 'window', windowid )
+            window.info = screen.get_xwininfo( window )
+        else:
+            window = screen.get_active_window()
+        parent.activeWindow = window
+        if ( not parent.valid_window() ):
+            raise CommandError( "no window to act on" )
+
+        geom = window.info['containergeom']
+        monitornum = screen.monitor_at( geom.x + geom.width // 2, geom.y + geom.height // 2 )
+        parent.currentMonitor = monitornum if monitornum is not None else 0
+        return window
+
+
+    def monitor( self, arg ):
+        monitornum = int( arg )
+        if ( not 0 <= monitornum < self.parent.screen.monitor['count'] ):
+            raise CommandError( "no monitor %d" % monitornum )
+        return monitornum
+
+
+    def desktop( self, arg ):
+        desktop = int( arg )
+        count = self.parent.screen.get_num_desktops()
+        if ( not 0 <= desktop < count ):
+            raise CommandError( "desktop must be 0 to %d" % ( count - 1 ) )
+        return desktop
+
+
+    def direction( self, args ):
+        '''( cursor keycode, repeat count ) from a "DIRECTION [COUNT]" argument list'''
+        keycode = directions.get( args[0].lower() )
+        if ( keycode is None ):
+            raise CommandError( "direction must be one of %s" % ", ".join( sorted( directions ) ) )
+        count = int( args[1] ) if len( args ) > 1 else 1
+        if ( count < 1 ):
+            raise CommandError( "count must be 1 or more" )
+        return ( keycode, count )
+
+
+    def client_info( self, c ):
+        return { "id": c.id, "class": list( c.wmclass ) if c.wmclass else None, "title": c.title, "pid": c.pid,
+                 "desktop": c.desktop, "monitor": c.monitor, "cells": c.cells, "rect": [ c.x, c.y, c.width, c.height ] }
+
+
+    ######## commands
+
+    def cmd_help( self, args ):
+        return [ "ping",
+                 "screen [N] - send this connection's commands to screen N (its position in Displays), or list the screens",
+                 "tile [@id] X0 Y0 X1 Y1 [MONITOR] - tile onto grid cells X0,Y0 to X1,Y1 (inclusive)",
+                 "move [@id] DIRECTION [COUNT] - move by grid cells - DIRECTION is up, down, left or right",
+                 "size_br [@id] DIRECTION [COUNT] - move the bottom or right edge by grid cells",
+                 "size_tl [@id] DIRECTION [COUNT] - move the top or left edge by grid cells",
+                 "focus [@id] DIRECTION - activate the nearest window in that direction",
+                 "swap [@id] DIRECTION - swap places with the nearest window in that direction",
+                 "desktop N - switch to desktop N",
+                 "send [@id] N - send the window to desktop N",
+                 "pack [MONITOR] - pack the windows on a monitor onto its grid",
+                 "save [PATH] - save the session",
+                 "restore [PATH] - restore the session",
+                 "query - active window, desktop and monitors",
+                 "windows - every managed window",
+                 "stats - the latency stats table" ]
+
+
+    def cmd_ping( self, args ):
+        return None
+
+
+    def cmd_screen( self, args ):
+        screens = self.parent.screens
+        if ( args ):
+            screennum = int( args[0] )
+            if ( not 0 <= screennum < len( screens ) ):
+                raise CommandError( "no screen %d" % screennum )
+            self.connection.screen = screens[screennum]
+            self.parent.use_screen( self.connection.screen )
+            return None
+        return { "current": self.parent.screen.index, "screens": [ screen.name for screen in screens ] }
+
+
+    def cmd_tile( self, args ):
+        parent = self.parent
+        self.target( args )
+        x0, y0, x1, y1 = [ int( a ) for a in args[:4] ]
+        if ( len( args ) > 4 ):
+            parent.currentMonitor = self.monitor( args[4] )
+        for x, y in ( ( x0, y0 ), ( x1, y1 ) ):
+            if ( not parent.is_ongrid( x, y ) ):
+                raise CommandError( "cell %d,%d is off the grid" % ( x, y ) )
+        parent.configureWin( *parent.get_lattice().cell_rect( min( x0, x1 ), min( y0, y1 ), max( x0, x1 ), max( y0, y1 ) ) )
+
+
+    def cmd_move( self, args ):
+        self.target( args )
+        self.parent.movewin( *self.direction( args ) )
+
+
+    def cmd_size_br( self, args ):
+        self.target( args )
+        self.parent.sizewinBR( *self.direction( args ) )
+
+
+    def cmd_size_tl( self, args ):
+        self.target( args )
+        self.parent.sizewinTL( *self.direction( args ) )
+
+
+    def cmd_focus( self, args ):
+        self.target( args )
+        self.parent.focus_neighbour( self.direction( args )[0] )
+
+
+    def cmd_swap( self, args ):
+        self.target( args )
+        self.parent.swap_neighbour( self.direction( args )[0] )
+
+
+    def cmd_desktop( self, args ):
+        screen = self.parent.screen
+        screen.send_event( screen.root, screen.atom._NET_CURRENT_DESKTOP, [ self.desktop( args[0] ) ], flush=False )
+
+
+    def cmd_send( self, args ):
+        window = self.target( args )
+        screen = self.parent.screen
+        screen.send_event( window, screen.atom._NET_WM_DESKTOP, [ self.desktop( args[0] ), 2 ], flush=False )
+
+
+    def cmd_pack( self, args ):
+        if ( args ):
+            self.parent.currentMonitor = self.monitor( args[0] )
+        self.parent.pack_monitor()
+
+
+    def cmd_save( self, args ):
+        return self.parent.session.save( args[0] if args else None )
+
+
+    def cmd_restore( self, args ):
+        return self.parent.session.restore( args[0] if args else None )
+
+
+    def cmd_query( self, args ):
+        screen = self.parent.screen
+        window = screen.get_active_window()
+        active = screen.registry.get( window.id )
+        monitors = []
+        for i in range( screen.monitor['count'] ):
+            m = screen.monitor[i]
+            monitors.append( { "rect": [ m.screenX, m.screenY, m.width, m.height ],
+                               "grid": [ m.lattice.gridX, m.lattice.gridY ] } )
+        return { "screen": screen.index,
+                 "active": self.client_info( active ) if active else None,
+                 "desktop": screen.get_current_desktop(),
+                 "monitors": monitors }
+
+
+    def cmd_windows( self, args ):
+        return [ self.client_info( c ) for c in self.parent.screen.registry.clients() ]
+
+
+    def cmd_stats( self, args ):
+        if ( not self.parent.stats ):
+            raise CommandError( "stats are off - set Stats_File in the config" )
+        return self.parent.stats.report()
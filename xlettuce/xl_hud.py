@@ -0,0 +1,155 @@
+#!/usr/bin/python3
+
+# xl_hud - Heads Up Display apps.
+# Each [HUD] app is started once, and its window is recognised by _NET_WM_PID when the WM adds it to the client list -
+# or by its WM_CLASS, if AppN_Class is set, for commands that don't run the app themselves (shell pipelines, apps that
+# hand off to an already running copy).  A slot stops waiting if no window turns up within windowwait seconds.
+# From then on the hotkey only hides (iconifies) or shows the window, so the app's startup cost is only ever paid once -
+# hiding is one request, showing is two (activate, then move into place), sent with a single flush.
+# HUD apps live on the first screen Xlettuce manages.
+
+import Xlib, functools, weakref
+import xutils
+import logging
+logger = logging.getLogger(__name__)
+
+
+class Hud:
+    '''the four HUD slots - a slot holds the app's settings, its pid once started, and its window id once it has appeared'''
+
+    IconicState = 3 # ICCCM WM_CHANGE_STATE - ask the WM to iconify a window
+    windowwait = 15 # seconds a started app has to show its window before the next press starts it again
+
+    def __init__( self, parent ):
+        self.parent = weakref.proxy(parent)
+        self.screen = parent.screens[0]
+        self.slots = [ xutils.Bunch( app=app, pid=None, client=None, hide=False, waiting=None ) for app in parent.snap.hud.apps ]
+
+        registry = self.screen.registry
+        registry.on_add.append( self.window_added )
+        registry.on_remove.append( self.window_removed )
+
+        if ( parent.snap.hud.start_hidden ):
+            for n, slot in enumerate( self.slots ):
+                if ( slot.app.command ):
+                    self.spawn( n, hide=True )
+
+
+    def configure( self, apps ):
+        '''the [HUD] settings changed - running apps stay up, and are shown with the new settings next time'''
+        for slot, app in zip( self.slots, apps ):
+            slot.app = app
+
+
+    def rect( self, app ):
+        '''frame rectangle ( x, y, width, height ) a HUD app is shown at - the top half of the primary monitor by default'''
+        if ( None not in ( app.pos_x, app.pos_y, app.width, app.height ) ):
+            return ( app.pos_x, app.pos_y, app.width, app.height )
+        workarea = self.screen.monitor[0].workarea
+        return ( workarea.screenX, workarea.screenY, workarea.width, workarea.height // 2 )
+
+
+    def spawn( self, n, hide=False ):
+        slot = self.slots[n]
+        slot.hide = hide
+        # on the HUD's screen, whatever $DISPLAY is - its window is only looked for there
+        slot.pid = self.parent.launcher.spawn( slot.app.command, on_exit=functools.partial( self.exited, n ), env=self.screen.environ() )
+        if ( slot.pid is not None ):
+            slot.waiting = self.parent.loop.call_later( self.windowwait, self.overdue, n )
+
+
+    def exited( self, n, pid, status ):
+        slot = self.slots[n]
+        if ( slot.pid == pid ):
+            slot.pid = None
+            if ( slot.waiting and not slot.app.wmclass ):
+                # gone without a window, and there's no class to look for one by
+                self.stop_waiting( slot )
+
+
+    def overdue( self, n ):
+        slot = self.slots[n]
+        slot.waiting = None
+        logger.warning("hud: no window from App%d after %d seconds - if its command doesn't run the app itself, set App%d_Class" % ( n + 1, self.windowwait, n + 1 ) )
+
+
+    def stop_waiting( self, slot ):
+        slot.waiting.cancel()
+        slot.waiting = None
+
+
+    def matches( self, slot, c ):
+        '''is c the window of the app slot is waiting for - by pid, or by WM_CLASS instance or class name if one is set'''
+        if ( slot.pid is not None and c.pid == slot.pid ):
+            return True
+        wmclass = slot.app.wmclass
+        if ( not wmclass ):
+            return False
+        name = xutils.class_name( c.wmclass ).lower() # "instance.class" - either part may contain dots itself
+        return name == wmclass or name.startswith( wmclass + "." ) or name.endswith( "." + wmclass )
+
+
+    def window_added( self, c ):
+        '''registry callback - adopt a new window if it belongs to a HUD app that's waiting for one'''
+        for slot in self.slots:
+            if ( slot.waiting and slot.client is None and self.matches( slot, c ) ):
+                self.adopt( slot, c )
+                return
+
+
+    def window_removed( self, c ):
+        for slot in self.slots:
+            if ( slot.client == c.id ):
+                # the app closed its window - forget it (the launcher still reaps the process), the next toggle starts a new one
+                slot.client = None
+                slot.pid = None
+
+
+    def adopt( self, slot, c ):
+        '''first sighting of a HUD app's window - keep it above the tiled windows, then show or hide it'''
+        screen = self.screen
+        self.stop_waiting( slot )
+        slot.client = c.id
+        logger.debug("hud: adopted window %s for pid %s" % ( hex( c.id ), c.pid ) )
+
+        # _NET_WM_STATE client message - action 1 (add), source indication 1 (application)
+        screen.send_event( c.window, screen.atom._NET_WM_STATE, [ 1, screen.atom._NET_WM_STATE_ABOVE, 0, 1 ], flush=False )
+        if ( slot.hide ):
+            self.hide( c )
+        else:
+            self.show( slot, c )
+
+
+    def hide( self, c ):
+        screen = self.screen
+        screen.send_event( c.window, screen.atom.WM_CHANGE_STATE, [ self.IconicState ] )
+
+
+    def show( self, slot, c ):
+        screen = self.screen
+        screen.send_event( c.window, screen.atom._NET_ACTIVE_WINDOW, [ 2, Xlib.X.CurrentTime, 0 ], flush=False )
+        self.parent.place_clients( [ ( c, None, self.rect( slot.app ) ) ], screen )
+
+
+    def toggle( self, n ):
+        '''
+        HUD hotkey - start the app if it isn't running.  Otherwise hide its window if it's the active one, and bring it
+        to the front (at its HUD position) if it's hidden or behind other windows.
+        '''
+        slot = self.slots[n]
+        if ( not slot.app.command ):
+            return
+
+        c = self.screen.registry.get( slot.client ) if slot.client is not None else None
+        if ( c is None ):
+            if ( not slot.waiting ):
+                self.spawn( n )
+            else:
+                slot.hide = False # still starting up - show it as soon as its window appears
+            return
+
+        hidden = self.screen.atom._NET_WM_STATE_HIDDEN in c.state
+        if ( not hidden and self.parent.screen is self.screen and self.parent.activeWindow.id == c.id ):
+            self.hide( c )
+        else:
+            self.show( slot, c )
@@ -0,0 +1,99 @@
+#!/usr/bin/python3
+
+# xl_lattice - the tiling grid for a monitor.  All grid math (snapping, moving and resizing along the grid, grid cells to
+# screen rectangles) is answered from precomputed cell boundaries.
+
+import bisect
+
+
+class Lattice:
+    '''
+    Tiling grid covering one monitor's work area.
+    Cell boundaries are precomputed in screen coordinates: xs[i] is the left edge of column i, and xs[gridX] is the right
+    edge of the work area - likewise ys for rows.  Leftover pixels are spread across the cells instead of being lost at the
+    right/bottom edge, and columns/rows can be weighted so some are wider than others (eg: a wide centre column).
+    '''
+
+    tolerance = 30 # px - a window edge this close to a boundary counts as being on it
+
+    def __init__( self, screenX, screenY, width, height, gridX, gridY, weightsX=None, weightsY=None ):
+        self.gridX = gridX # number of grid hotkeys (columns)
+        self.gridY = gridY # number of grid hotkeys (rows)
+        self.slotsX = gridX
+        self.slotsY = gridY
+        self.xs = self.boundaries( screenX, width, gridX, weightsX )
+        self.ys = self.boundaries( screenY, height, gridY, weightsY )
+        self.edges = { 'x': self.xs, 'y': self.ys }
+
+        # average cell size
+        self.slotWidth = width // gridX
+        self.slotHeight = height // gridY
+
+
+    @staticmethod
+    def boundaries( origin, length, count, weights=None ):
+        '''split length pixels into count cells, in proportion to weights (equal if None).  Returns the count+1 cell edges.'''
+        if ( not weights ):
+            weights = [1] * count
+        total = float( sum( weights ) )
+        edges = [ origin ]
+        acc = 0
+        for w in weights:
+            acc += w
+            edges.append( origin + int( round( length * acc / total ) ) )
+        return edges
+
+
+    def cell_rect( self, x0, y0, x1, y1 ):
+        '''screen rectangle (x, y, width, height) covering grid cells x0..x1, y0..y1 inclusive'''
+        return ( self.xs[x0], self.ys[y0], self.xs[x1 + 1] - self.xs[x0], self.ys[y1 + 1] - self.ys[y0] )
+
+
+    def snap( self, axis, pos ):
+        '''index of the boundary nearest to screen coordinate pos'''
+        edges = self.edges[axis]
+        i = bisect.bisect_left( edges, pos )
+        if ( i >= len( edges ) ):
+            return len( edges ) - 1
+        if ( i > 0 and pos - edges[i - 1] <= edges[i] - pos ):
+            return i - 1
+        return i
+
+
+    def span( self, axis, start, length ):
+        '''cells (first, last) a window edge-to-edge span snaps onto - always at least one cell'''
+        first = min( self.snap( axis, start ), len( self.edges[axis] ) - 2 )
+        last = max( first, self.snap( axis, start + length ) - 1 )
+        return ( first, last )
+
+
+    def step( self, axis, pos, steps, lo, hi ):
+        '''
+        Boundary reached by moving pos across steps boundaries - forwards (right/down) if steps > 0, backwards if steps < 0.
+        Positions within the tolerance of a boundary count as on it.  The resulting boundary index is clamped to lo..hi.
+        '''
+        edges = self.edges[axis]
+        if ( steps > 0 ):
+            i = bisect.bisect_right( edges, pos + self.tolerance ) - 1 + steps
+        else:
+            i = bisect.bisect_left( edges, pos - self.tolerance ) + steps
+        return edges[ max( lo, min( hi, i ) ) ]
+
+
+    def move( self, axis, start, steps ):
+        '''new start (left/top) edge for a window moved steps cells along axis.  The window keeps its start edge inside the grid.'''
+        return self.step( axis, start, steps, 0, len( self.edges[axis] ) - 2 )
+
+
+    def resize_end( self, axis, start, end, steps ):
+        '''new end (right/bottom) edge when the end of a window moves steps cells.  The window stays at least a cell in size.'''
+        edges = self.edges[axis]
+        lo = max( 1, bisect.bisect_right( edges, start + self.tolerance ) )
+        return self.step( axis, end, steps, lo, len( edges ) - 1 )
+
+
+    def resize_start( self, axis, start, end, steps ):
+        '''new start (left/top) edge when the start of a window moves steps cells, with the end edge fixed.'''
+        edges = self.edges[axis]
+        hi = min( len( edges ) - 2, bisect.bisect_left( edges, end - self.tolerance ) - 1 )
+        return self.step( axis, start, steps, 0, max( 0, hi ) )
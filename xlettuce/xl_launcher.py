@@ -0,0 +1,87 @@
+#!/usr/bin/python3
+
+# xl_launcher - start commands without blocking the event loop.
+# Commands arrive already split into argv (see xl_config.parse_command), and are started with posix_spawn, which doesn't
+# copy Xlettuce's memory the way fork() does.  Children are reaped from the event loop when they exit - through a pidfd
+# per child where the kernel supports it, or a SIGCHLD handler otherwise - so nothing ever waits on them.
+
+import os, signal, functools
+import logging
+logger = logging.getLogger(__name__)
+
+
+class Launcher:
+    '''spawns commands, and reaps them when they exit'''
+
+    def __init__( self, loop ):
+        self.loop = loop
+        self.children = {} # pid -> ( argv, pidfd or None, on_exit callback or None )
+        self.use_pidfd = hasattr( os, 'pidfd_open' )
+        self.sigchld = False
+        if ( not self.use_pidfd ):
+            self.watch_sigchld()
+
+
+    def watch_sigchld( self ):
+        if ( not self.sigchld ):
+            self.loop.add_signal_handler( signal.SIGCHLD, self.reap_all )
+            self.sigchld = True
+
+
+    def spawn( self, argv, on_exit=None, env=None ):
+        '''
+        Start argv in its own session, so it outlives Xlettuce.  on_exit( pid, status ) is called from the loop when it exits.
+        env is the child's environment - Xlettuce's own if None.  Returns the child's pid, or None if it couldn't be started.
+        '''
+        env = os.environ if env is None else env
+        try:
+            if ( hasattr( os, 'posix_spawnp' ) ):
+                pid = os.posix_spawnp( argv[0], argv, env, setsid=True )
+            else:
+                import subprocess # only needed without posix_spawn - it's slow to import
+                pid = subprocess.Popen( argv, start_new_session=True, env=env ).pid
+        except OSError as err:
+            logger.warning("launcher: couldn't run %s: %s" % ( " ".join( argv ), err ) )
+            return None
+
+        pidfd = None
+        if ( self.use_pidfd ):
+            try:
+                pidfd = os.pidfd_open( pid )
+            except OSError:
+                # kernel older than 5.3 - fall back to SIGCHLD for this and every later child
+                self.use_pidfd = False
+                self.watch_sigchld()
+
+        self.children[pid] = ( argv, pidfd, on_exit )
+        if ( pidfd is not None ):
+            self.loop.add_reader( pidfd, functools.partial( self.reap, pid ) )
+
+        logger.debug("launcher: started %s (pid %d)" % ( " ".join( argv ), pid ) )
+        return pid
+
+
+    def reap( self, pid ):
+        '''collect a child's exit status, if it has exited.  Returns True if it was reaped.'''
+        try:
+            done, status = os.waitpid( pid, os.WNOHANG )
+        except ChildProcessError:
+            done, status = pid, 0 # already reaped elsewhere
+        if ( done == 0 ):
+            return False
+
+        argv, pidfd, on_exit = self.children.pop( pid, ( None, None, None ) )
+        if ( pidfd is not None ):
+            self.loop.remove_reader( pidfd )
+            os.close( pidfd )
+        if ( argv is not None ):
+            logger.debug("launcher: %s (pid %d) exited with status %d" % ( argv[0], pid, os.waitstatus_to_exitcode( status ) if status else 0 ) )
+        if ( on_exit ):
+            on_exit( pid, status )
+        return True
+
+
+    def reap_all( self ):
+        '''SIGCHLD - one signal can stand for several children, so check them all'''
+        for pid in list( self.children ):
+            self.reap( pid )
@@ -0,0 +1,151 @@
+#!/usr/bin/python3
+
+# xl_layout - automatic layouts on a monitor's tiling grid.
+# pack() fits a set of windows onto the grid without overlaps, keeping each one as close to where it already is (and as
+# big as it already is) as its minimum size and the other windows allow.  Grid occupancy is a bitmask, one bit per cell,
+# so testing whether a rectangle is free is a single AND.
+
+import logging
+logger = logging.getLogger(__name__)
+
+PMinSize = 1 << 4 # WM_NORMAL_HINTS flag - min_width/min_height are set
+
+
+def min_size( client ):
+    '''minimum frame size ( width, height ) for a client, from WM_NORMAL_HINTS plus its frame extents'''
+    left, right, top, bottom = client.extents
+    hints = client.hints
+    if ( hints and len( hints ) >= 7 and hints[0] & PMinSize ):
+        return ( hints[5] + left + right, hints[6] + top + bottom )
+    return ( 0, 0 )
+
+
+class Packer:
+    '''
+    Packs windows onto a Lattice without overlaps, keeping each window near its current cells and at or above its minimum size.
+    '''
+
+    def __init__( self, lattice ):
+        self.lattice = lattice
+        self.gridX = lattice.gridX
+        self.gridY = lattice.gridY
+        self.used = 0 # occupancy bitmask - bit ( y * gridX + x ) is set if cell x, y is taken
+
+        # rowmask[w] covers w cells of a row starting at column 0 - shifted into place to build rectangle masks
+        self.rowmask = [ ( 1 << w ) - 1 for w in range( self.gridX + 1 ) ]
+
+
+    def mask( self, x0, y0, x1, y1 ):
+        '''occupancy bits for cells x0..x1, y0..y1 inclusive'''
+        row = self.rowmask[ x1 - x0 + 1 ] << x0
+        m = 0
+        for y in range( y0, y1 + 1 ):
+            m |= row << ( y * self.gridX )
+        return m
+
+
+    def fits( self, cells, minwidth, minheight ):
+        '''True if cells are free and big enough for the minimum size'''
+        x0, y0, x1, y1 = cells
+        xs, ys = self.lattice.xs, self.lattice.ys
+        if ( xs[x1 + 1] - xs[x0] < minwidth or ys[y1 + 1] - ys[y0] < minheight ):
+            return False
+        return not ( self.used & self.mask( *cells ) )
+
+
+    def candidates( self, cells ):
+        '''
+        Every rectangle a window currently on cells could be put in, best first: smallest area first (then nearest to the
+        window's current shape), each size at the positions nearest to the middle of the current cells.
+        '''
+        x0, y0, x1, y1 = cells
+        width = x1 - x0 + 1
+        height = y1 - y0 + 1
+
+        sizes = [ ( w, h ) for w in range( 1, self.gridX + 1 ) for h in range( 1, self.gridY + 1 ) ]
+        sizes.sort( key=lambda s: ( s[0] * s[1], abs( s[0] - width ) + abs( s[1] - height ) ) )
+
+        for w, h in sizes:
+            positions = [ ( x, y ) for x in range( self.gridX - w + 1 ) for y in range( self.gridY - h + 1 ) ]
+            # middle of the candidate vs middle of the current cells, in doubled units to stay in integers
+            positions.sort( key=lambda p: abs( 2 * p[0] + w - x0 - x1 - 1 ) + abs( 2 * p[1] + h - y0 - y1 - 1 ) )
+            for x, y in positions:
+                yield ( x, y, x + w - 1, y + h - 1 )
+
+
+    def place( self, cells, minsize ):
+        '''claim the smallest free rectangle near cells that meets minsize.  Returns the new cells, or None if nothing fits.'''
+        for candidate in self.candidates( cells ):
+            if ( self.fits( candidate, *minsize ) ):
+                self.used |= self.mask( *candidate )
+                return candidate
+        return None
+
+
+    def grow( self, cells, limit ):
+        '''
+        Expand a placed rectangle by one free row or column - right, down, left or up, whichever comes first - without going
+        past limit ( x0, y0, x1, y1 ).  Returns the new cells, or None if it can't grow.
+        '''
+        x0, y0, x1, y1 = cells
+        lx0, ly0, lx1, ly1 = limit
+        if ( x1 < lx1 and not self.used & self.mask( x1 + 1, y0, x1 + 1, y1 ) ):
+            x1 += 1
+            strip = ( x1, y0, x1, y1 )
+        elif ( y1 < ly1 and not self.used & self.mask( x0, y1 + 1, x1, y1 + 1 ) ):
+            y1 += 1
+            strip = ( x0, y1, x1, y1 )
+        elif ( x0 > lx0 and not self.used & self.mask( x0 - 1, y0, x0 - 1, y1 ) ):
+            x0 -= 1
+            strip = ( x0, y0, x0, y1 )
+        elif ( y0 > ly0 and not self.used & self.mask( x0, y0 - 1, x1, y0 - 1 ) ):
+            y0 -= 1
+            strip = ( x0, y0, x1, y0 )
+        else:
+            return None
+        self.used |= self.mask( *strip )
+        return ( x0, y0, x1, y1 )
+
+
+    def pack( self, windows ):
+        '''
+        windows is a list of ( key, cells, ( minwidth, minheight ) ) - cells is where the window is now.
+        Returns a list of ( key, cells ) for every window that could be fitted in.  Windows that don't fit are left out.
+
+        Every window first gets the smallest spot that meets its minimum size, as near as possible to where it is (biggest
+        windows choose first), so as many windows as possible fit.  Then they take turns growing a row or column at a time,
+        back towards their current size, and finally into whatever free cells are left, so the grid ends up covered.
+        '''
+        order = sorted( windows, key=lambda w: -( w[1][2] - w[1][0] + 1 ) * ( w[1][3] - w[1][1] + 1 ) )
+        whole = ( 0, 0, self.gridX - 1, self.gridY - 1 )
+
+        placed = []
+        for key, cells, minsize in order:
+            x0, y0, x1, y1 = cells
+            cells = ( min( x0, self.gridX - 1 ), min( y0, self.gridY - 1 ), min( x1, self.gridX - 1 ), min( y1, self.gridY - 1 ) )
+            # a minimum size bigger than the monitor can't be honoured - just ask for a cell
+            if ( minsize[0] > self.lattice.xs[-1] - self.lattice.xs[0] or minsize[1] > self.lattice.ys[-1] - self.lattice.ys[0] ):
+                minsize = ( 0, 0 )
+            new = self.place( cells, minsize )
+            if ( new is None ):
+                logger.debug("pack: no room for %s" % ( key, ) )
+                continue
+            placed.append( [ key, new, cells ] )
+
+        for limited in ( True, False ):
+            growing = list( placed )
+            while ( growing ):
+                still = []
+                for entry in growing:
+                    new = self.grow( entry[1], entry[2] if limited else whole )
+                    if ( new is not None ):
+                        entry[1] = new
+                        still.append( entry )
+                growing = still
+
+        return [ ( key, cells ) for key, cells, original in placed ]
+
+
+def pack( lattice, windows ):
+    '''pack windows onto a lattice - see Packer.pack'''
+    return Packer( lattice ).pack( windows )
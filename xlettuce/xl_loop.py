@@ -0,0 +1,252 @@
+#!/usr/bin/python3
+
+# xl_loop - small select-based event loop.  Waits on the X display connection (and any other file descriptors)
+# instead of sleeping, runs timers when they come due, and watches files for changes.
+
+import selectors, heapq, itertools, time, os, struct, ctypes, signal
+import logging
+logger = logging.getLogger(__name__)
+
+
+class Timer:
+    '''handle returned by EventLoop.call_later - call cancel() to stop the timer from firing'''
+
+    def __init__( self, deadline, callback, args ):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel( self ):
+        self.cancelled = True
+
+
+class EventLoop:
+    '''
+    Waits for activity on registered file descriptors, and for timers to come due.
+    Nothing sleeps while work is queued - the loop only blocks in select() when every reader is drained and no timer is due.
+    '''
+
+    def __init__( self ):
+        self.selector = selectors.DefaultSelector()
+        self.timers = [] # heap of (deadline, sequence, Timer)
+        self.sequence = itertools.count() # tie breaker for timers with identical deadlines
+        self.pending = {} # fd -> callable returning True when data is already buffered in userspace (eg: Xlib's event queue)
+        self.signals = {} # signal number -> callback
+        self.wakeup = None # ( read fd, write fd ) of the pipe signals are reported through
+        self.running = False
+
+
+    def add_reader( self, fd, callback, pending=None ):
+        '''Call callback() whenever fd becomes readable.
+        pending is an optional callable that returns True when the reader already has buffered data waiting -
+        Xlib reads events off the socket while waiting for replies, so the display fd can be quiet while events are queued.
+        '''
+        self.watch( fd, 0, callback )
+        if pending:
+            self.pending[fd] = pending
+
+
+    def remove_reader( self, fd ):
+        self.watch( fd, 0, None )
+        self.pending.pop( fd, None )
+
+
+    def add_writer( self, fd, callback ):
+        '''Call callback() whenever fd can be written to - remove the writer once there's nothing left to send'''
+        self.watch( fd, 1, callback )
+
+
+    def remove_writer( self, fd ):
+        self.watch( fd, 1, None )
+
+
+    def watch( self, fd, which, callback ):
+        '''set the reader (which=0) or writer (which=1) callback for fd - the selector key's data is [ reader, writer ]'''
+        try:
+            callbacks = list( self.selector.get_key( fd ).data )
+        except ( KeyError, ValueError ):
+            callbacks = [ None, None ]
+        callbacks[which] = callback
+
+        events = ( selectors.EVENT_READ if callbacks[0] else 0 ) | ( selectors.EVENT_WRITE if callbacks[1] else 0 )
+        try:
+            if ( not events ):
+                self.selector.unregister( fd )
+            else:
+                self.selector.modify( fd, events, callbacks )
+        except ( KeyError, ValueError ):
+            if ( events ):
+                self.selector.register( fd, events, callbacks )
+
+
+    def add_signal_handler( self, signum, callback ):
+        '''Call callback() from the loop whenever signal signum arrives - never from inside the signal handler itself.
+        Python writes the number of each signal it catches to a wakeup pipe, which is read like any other fd.
+        '''
+        if ( self.wakeup is None ):
+            rfd, wfd = os.pipe()
+            os.set_blocking( rfd, False )
+            os.set_blocking( wfd, False )
+            signal.set_wakeup_fd( wfd )
+            self.wakeup = ( rfd, wfd )
+            self.add_reader( rfd, self.read_signals )
+        self.signals[signum] = callback
+        signal.signal( signum, lambda signum, frame: None ) # the work happens in read_signals
+
+
+    def read_signals( self ):
+        try:
+            data = os.read( self.wakeup[0], 512 )
+        except BlockingIOError:
+            return
+        for signum in set( data ):
+            callback = self.signals.get( signum )
+            if ( callback ):
+                callback()
+
+
+    def call_later( self, delay, callback, *args ):
+        '''Run callback(*args) after delay seconds.  Returns a Timer that can be cancelled.'''
+        timer = Timer( time.monotonic() + delay, callback, args )
+        heapq.heappush( self.timers, ( timer.deadline, next(self.sequence), timer ) )
+        return timer
+
+
+    def stop( self ):
+        self.running = False
+
+
+    def run_timers( self ):
+        '''run every timer that has come due.  Returns the number of seconds until the next one, or None if there are none.'''
+        while self.timers:
+            deadline, seq, timer = self.timers[0]
+            if timer.cancelled:
+                heapq.heappop( self.timers )
+                continue
+            now = time.monotonic()
+            if deadline > now:
+                return deadline - now
+            heapq.heappop( self.timers )
+            timer.callback( *timer.args )
+        return None
+
+
+    def run_once( self ):
+        '''wait for one round of activity and dispatch it'''
+        timeout = self.run_timers()
+
+        # readers with data already buffered are serviced without blocking
+        ready = [ fd for fd, pending in self.pending.items() if pending() ]
+        if ready:
+            for fd in ready:
+                if fd in self.pending:
+                    self.selector.get_key( fd ).data[0]()
+            return
+
+        for key, mask in self.selector.select( timeout ):
+            reader, writer = key.data
+            if ( mask & selectors.EVENT_READ and reader ):
+                reader()
+            if ( mask & selectors.EVENT_WRITE and writer ):
+                # the reader may have just removed this writer (or closed the fd) - look it up again
+                try:
+                    writer = self.selector.get_key( key.fd ).data[1]
+                except ( KeyError, ValueError ):
+                    writer = None
+                if ( writer ):
+                    writer()
+
+
+    def run( self ):
+        self.running = True
+        while self.running:
+            self.run_once()
+
+
+class FileWatcher:
+    '''
+    Calls callback() shortly after a file is written or replaced.
+    Watches the file's directory with inotify (editors often save by renaming a new file over the old one), through a
+    non-blocking fd serviced by the event loop.  Falls back to checking the file's mtime on a timer if inotify isn't available.
+    '''
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+
+    def __init__( self, loop, path, callback, delay=0.2, pollinterval=2.0 ):
+        self.loop = loop
+        self.path = os.path.abspath( path )
+        self.filename = os.fsencode( os.path.basename( self.path ) )
+        self.callback = callback
+        self.delay = delay # wait for a burst of writes to settle before calling back
+        self.pollinterval = pollinterval
+        self.timer = None
+        self.fd = self.init_inotify()
+
+        if ( self.fd is None ):
+            logger.info("inotify unavailable - polling %s for changes every %ss" % ( self.path, pollinterval ) )
+            self.mtime = self.get_mtime()
+            self.loop.call_later( self.pollinterval, self.poll )
+        else:
+            self.loop.add_reader( self.fd, self.read_events )
+
+
+    def init_inotify( self ):
+        try:
+            libc = ctypes.CDLL( None, use_errno=True )
+            fd = libc.inotify_init1( os.O_NONBLOCK | os.O_CLOEXEC )
+            if ( fd < 0 ):
+                return None
+            mask = self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE
+            if ( libc.inotify_add_watch( fd, os.fsencode( os.path.dirname( self.path ) ), mask ) < 0 ):
+                os.close( fd )
+                return None
+            return fd
+        except ( OSError, AttributeError ):
+            return None
+
+
+    def read_events( self ):
+        try:
+            buf = os.read( self.fd, 4096 )
+        except BlockingIOError:
+            return
+
+        # struct inotify_event { int wd; uint32_t mask; uint32_t cookie; uint32_t len; char name[len]; }
+        offset = 0
+        while offset < len( buf ):
+            wd, mask, cookie, length = struct.unpack_from( "iIII", buf, offset )
+            offset += 16
+            name = buf[offset:offset + length].rstrip( b"\0" )
+            offset += length
+            if ( name == self.filename ):
+                self.changed()
+
+
+    def poll( self ):
+        mtime = self.get_mtime()
+        if ( mtime != self.mtime ):
+            self.mtime = mtime
+            self.changed()
+        self.loop.call_later( self.pollinterval, self.poll )
+
+
+    def get_mtime( self ):
+        try:
+            return os.stat( self.path ).st_mtime_ns
+        except OSError:
+            return None
+
+
+    def changed( self ):
+        # restart the settle timer on every change, so a save that writes in several steps is only reported once
+        if ( self.timer ):
+            self.timer.cancel()
+        self.timer = self.loop.call_later( self.delay, self.fire )
+
+
+    def fire( self ):
+        self.timer = None
+        self.callback()
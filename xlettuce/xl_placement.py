@@ -0,0 +1,188 @@
+#!/usr/bin/python3
+
+# xl_placement - learned per-application placement corrections.
+# Some apps (GTK ones especially) end up somewhere other than where they were asked to go - eg: off on the Y axis by the
+# height of the title bar.  The offset between the target and where each WM_CLASS actually lands is recorded per window
+# manager (decorations differ between WMs), persisted between runs, and applied up front, so after the first encounter a
+# window lands right on the first request.
+
+import json, os
+import Xlib.error
+import xutils
+import logging
+logger = logging.getLogger(__name__)
+
+
+# WM_NORMAL_HINTS flags and fields - see xl_layout.min_size
+PMinSize = 1 << 4
+PMaxSize = 1 << 5
+PResizeInc = 1 << 6
+PBaseSize = 1 << 8
+
+def hinted_size( hints, width, height ):
+    '''
+    the client size a WM that follows WM_NORMAL_HINTS gives a window asked to be width x height - snapped down to its
+    resize increments (terminals, etc) and clamped to its min / max size
+    '''
+    if ( not hints or len( hints ) < 11 ):
+        return ( width, height )
+    flags = hints[0]
+    sizes = []
+    for i, size in enumerate( ( width, height ) ):
+        increment = hints[9 + i]
+        if ( flags & PResizeInc and increment > 1 ):
+            if ( flags & PBaseSize and len( hints ) >= 17 ):
+                base = hints[15 + i]
+            elif ( flags & PMinSize ):
+                base = hints[5 + i]
+            else:
+                base = 0
+            if ( size > base ):
+                size = base + ( size - base ) // increment * increment
+        if ( flags & PMaxSize and hints[7 + i] > 0 ):
+            size = min( size, hints[7 + i] )
+        if ( flags & PMinSize ):
+            size = max( size, hints[5 + i] )
+        sizes.append( size )
+    return tuple( sizes )
+
+
+class PlacementCache:
+    '''
+    WM name -> WM_CLASS -> Bunch( method, offset ) - method is "ewmh" (_NET_MOVERESIZE_WINDOW) or "configure", and offset
+    is the [ x, y, width, height ] correction added to every request for that class under that WM.
+    Placements are checked asynchronously: once a window's frame has settled (no ConfigureNotify for a moment), its geometry
+    is compared with the target, the correction is updated, and the window is nudged into place if it missed.
+    Size misses the window's own WM_NORMAL_HINTS explain (resize increments, min / max size) aren't the class's fault, and
+    are left out - only what's left is learned.
+    '''
+
+    settle = 0.1 # seconds without a ConfigureNotify before a placement counts as finished
+    timeout = 0.5 # seconds to wait for the first ConfigureNotify before giving up on checking a placement
+    savedelay = 2.0 # batch up writes to the cache file
+
+    def __init__( self, path, loop ):
+        self.path = path
+        self.loop = loop
+        self.records = {}
+        self.pending = {} # container window id -> Bunch describing an unverified placement
+        self.savetimer = None
+        self.load()
+
+
+    def load( self ):
+        try:
+            with open( self.path ) as f:
+                data = json.load( f )
+        except ( EnvironmentError, ValueError ):
+            return
+        for wm, classes in data.items():
+            if ( not isinstance( classes, dict ) ):
+                continue # a class entry from a cache that wasn't kept per WM - there's no telling which WM it was learned under
+            for wmclass, record in classes.items():
+                try:
+                    self.records.setdefault( wm, {} )[wmclass] = xutils.Bunch( method=str( record[0] ), offset=[ int(v) for v in record[1:5] ] )
+                except ( IndexError, TypeError, ValueError ):
+                    continue # ignore damaged entries
+
+
+    def save( self ):
+        self.savetimer = None
+        data = dict( ( wm, dict( ( wmclass, [ r.method ] + r.offset ) for wmclass, r in classes.items() ) )
+                     for wm, classes in self.records.items() )
+        try:
+            with open( self.path + ".tmp", 'w' ) as f:
+                json.dump( data, f, separators=(',', ':') )
+            os.replace( self.path + ".tmp", self.path )
+        except EnvironmentError as err:
+            logger.warning("couldn't save placement cache %s: %s" % ( self.path, err ) )
+
+
+    def schedule_save( self ):
+        if ( self.savetimer is None ):
+            self.savetimer = self.loop.call_later( self.savedelay, self.save )
+
+
+    def get( self, wmclass, wm ):
+        return self.records.get( wm, {} ).get( xutils.class_name( wmclass ) )
+
+
+    def expect( self, screen, window, method, target, base ):
+        '''
+        Register a placement that was just sent, to be checked once the window's frame settles.
+        target is the frame rectangle we want.  base is the uncorrected request for it - frame x, y and client width, height -
+        which had the class's offset added before it was sent using method.
+        '''
+        container = window.info['container']
+        old = self.pending.pop( container.id, None )
+        if ( old ):
+            old.timer.cancel()
+
+        # the client size that was actually sent - base plus the correction get_placement handed out
+        record = self.get( window.info['WM_CLASS'], screen.wm_name )
+        sent = [ b + o for b, o in zip( base, record.offset if record else ( 0, 0, 0, 0 ) ) ]
+
+        pending = xutils.Bunch( screen=screen, window=window, wmclass=xutils.class_name( window.info['WM_CLASS'] ),
+                                wm=screen.wm_name, method=method, target=tuple( target ), base=tuple( base ),
+                                size=tuple( sent[2:] ), geom=None, timer=None )
+        pending.timer = self.loop.call_later( self.timeout, self.verify, container.id )
+        self.pending[ container.id ] = pending
+
+
+    def observe( self, event ):
+        '''ConfigureNotify - note where a pending window's frame has got to, and wait for it to settle'''
+        pending = self.pending.get( event.window.id )
+        if ( pending is None ):
+            return
+        pending.geom = ( event.x, event.y, event.width, event.height )
+        pending.timer.cancel()
+        pending.timer = self.loop.call_later( self.settle, self.verify, event.window.id )
+
+
+    def hinted_size( self, pending ):
+        '''( width, height ) the window's WM_NORMAL_HINTS allow for the client size that was sent - from the registry, so no round trip'''
+        try:
+            c = pending.screen.registry.get( pending.window.id )
+        except Xlib.error.XError:
+            c = None
+        if ( c is None ):
+            return pending.size
+        return hinted_size( c.hints, *pending.size )
+
+
+    def verify( self, containerid ):
+        pending = self.pending.pop( containerid, None )
+        if ( pending is None or pending.geom is None ):
+            return # the frame never moved - it was already in place, or the window went away
+
+        records = self.records.setdefault( pending.wm, {} )
+        record = records.get( pending.wmclass )
+        miss = [ t - g for t, g in zip( pending.target, pending.geom ) ]
+
+        # the WM shrinking a window onto its resize increments, or holding it at its min / max size, is the window asking
+        # for it - take that out of the miss, so terminals and the like aren't "corrected" on every move
+        width, height = self.hinted_size( pending )
+        miss[2] -= pending.size[0] - width
+        miss[3] -= pending.size[1] - height
+
+        if ( not any( miss ) ):
+            if ( record is None or record.method != pending.method ):
+                records[ pending.wmclass ] = xutils.Bunch( method=pending.method, offset=record.offset if record else [0, 0, 0, 0] )
+                self.schedule_save()
+            return
+
+        if ( pending.method == "ewmh" and any( miss[:2] ) and ( record is None or record.method != "ewmh" ) ):
+            # first try with _NET_MOVERESIZE_WINDOW landed in the wrong place - use configure for this class from now on.
+            # A size-only miss doesn't count against it: the move worked, the size just needs a correction.
+            logger.debug("placement: %s ignores _NET_MOVERESIZE_WINDOW, switching to configure" % pending.wmclass )
+            record = xutils.Bunch( method="configure", offset=[0, 0, 0, 0] )
+        else:
+            record = xutils.Bunch( method=pending.method, offset=[ o + m for o, m in zip( record.offset if record else [0, 0, 0, 0], miss ) ] )
+            logger.debug("placement: %s lands off target by %s - correction now %s" % ( pending.wmclass, miss, record.offset ) )
+
+        records[ pending.wmclass ] = record
+        self.schedule_save()
+
+        # nudge this window into place - once, without waiting to check the result
+        x, y, width, height = [ b + o for b, o in zip( pending.base, record.offset ) ]
+        pending.screen.place( pending.window, record.method, x, y, width, height, flush=True )
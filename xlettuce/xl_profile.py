@@ -0,0 +1,92 @@
+#!/usr/bin/python3
+
+# xl_profile - on-demand profiling of a running Xlettuce.
+# kill -USR1 <pid> starts profiling event dispatch with cProfile, and a second SIGUSR1 stops it and writes one pstats file
+# per action (tilekey, movewin, ...) next to the log, ready for python3 -m pstats, snakeviz, gprof2dot, etc.
+# Nothing is hooked in while profiling is off - the event loop only checks a flag.
+# StartupTrace times the phases of startup, for xlettuce.py --startup-trace.
+
+import os, signal, time
+import logging
+logger = logging.getLogger(__name__)
+
+
+class Profiler:
+    '''collects a profile of each dispatched event, merged per action label'''
+
+    def __init__( self, loop, directory ):
+        self.directory = directory
+        self.active = False
+        self.profile = None # profile of the event being dispatched
+        self.stats = {} # action label -> pstats.Stats
+        self.started = None
+        loop.add_signal_handler( signal.SIGUSR1, self.toggle )
+
+
+    def toggle( self ):
+        if ( self.active ):
+            self.stop()
+        else:
+            self.start()
+
+
+    def start( self ):
+        # imported on first use - pstats alone takes longer to import than the rest of startup
+        global cProfile, pstats
+        import cProfile, pstats
+        self.stats = {}
+        self.started = time.strftime( "%Y%m%d-%H%M%S" )
+        self.active = True
+        logger.warning("profiler: started - send SIGUSR1 (kill -USR1 %d) again to stop and write the results" % os.getpid() )
+
+
+    def stop( self ):
+        self.active = False
+        written = []
+        for label, stats in sorted( self.stats.items() ):
+            path = os.path.join( self.directory, "xlettuce.%s.%s.pstats" % ( self.started, label ) )
+            try:
+                stats.dump_stats( path )
+                written.append( path )
+            except EnvironmentError as err:
+                logger.warning("profiler: couldn't write %s: %s" % ( path, err ) )
+        self.stats = {}
+        logger.warning("profiler: stopped - wrote %s" % ( ", ".join( written ) or "nothing, no events were dispatched" ) )
+
+
+    def enable( self ):
+        '''start profiling one event'''
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+
+
+    def collect( self, label ):
+        '''stop profiling the event, and merge it into the totals for its action'''
+        self.profile.disable()
+        stats = self.stats.get( label )
+        if ( stats is None ):
+            self.stats[label] = pstats.Stats( self.profile )
+        else:
+            stats.add( self.profile )
+        self.profile = None
+
+
+class StartupTrace:
+    '''wall clock time taken by each phase of startup - mark() ends the current phase'''
+
+    def __init__( self, start=None ):
+        self.start = self.last = start or time.perf_counter()
+        self.phases = [] # ( name, seconds )
+
+    def mark( self, name ):
+        now = time.perf_counter()
+        self.phases.append( ( name, now - self.last ) )
+        self.last = now
+
+    def total( self ):
+        return self.last - self.start
+
+    def report( self ):
+        lines = [ "%-20s %9.2f ms" % ( name, 1000 * seconds ) for name, seconds in self.phases ]
+        lines.append( "%-20s %9.2f ms" % ( "total", 1000 * self.total() ) )
+        return "\n".join( lines ) + "\n"
@@ -0,0 +1,277 @@
+#!/usr/bin/python3
+
+# xl_registry - in-memory registry of every managed window.
+# Bootstrapped from _NET_CLIENT_LIST with one batched probe, then kept current from events on the root window, so anything
+# that needs to know about windows other than the active one (sessions, layouts, directional moves) can ask memory instead
+# of the X server.
+
+import Xlib, Xlib.error, Xlib.protocol.request
+import xutils
+import logging
+logger = logging.getLogger(__name__)
+
+
+class WindowRegistry:
+    '''
+    client window id -> Bunch, as returned by Screen.probe_clients, plus:
+        frame - id of the client's container (top level WM frame, or the client itself with a non-reparenting WM)
+        monitor - index of the monitor the middle of the frame is on (None if it's off screen)
+        cells - grid cells ( x0, y0, x1, y1 ) the frame snaps onto on that monitor (None for panels and off screen windows)
+    A per-monitor index maps each grid cell to the ids of the windows covering it.
+
+    Clients come and go with _NET_CLIENT_LIST (a window created on the root isn't a client until the WM manages it, so
+    CreateNotify alone isn't enough).  Frames are moved/resized/destroyed as seen by SubstructureNotify on the root, and
+    property changes on the clients (title, desktop, frame extents...) mark them stale, to be probed again in one batch the
+    next time the registry is queried.
+    '''
+
+    # client properties worth probing again when they change
+    watchedatoms = ( 'WM_NAME', 'WM_CLASS', 'WM_NORMAL_HINTS', '_NET_WM_NAME', '_NET_WM_DESKTOP', '_NET_FRAME_EXTENTS', '_NET_WM_WINDOW_TYPE',
+                     '_NET_WM_STATE' )
+
+    def __init__( self, screen ):
+        self.screen = screen
+        self.clientmap = {} # client id -> Bunch
+        self.frames = {} # frame id -> client id
+        self.cells = {} # monitor index -> { ( column, row ): set of client ids }
+        self.stale = set() # client ids whose properties changed since they were last probed
+        self.on_add = [] # callables called with each new client Bunch
+        self.on_remove = [] # callables called with each client Bunch that has gone away
+
+        self.watched = set( screen.atom[name] for name in self.watchedatoms )
+        self.panels = ( screen.atom._NET_WM_WINDOW_TYPE_DOCK, screen.atom._NET_WM_WINDOW_TYPE_DESKTOP )
+
+        # frames are children of the root - their moves, resizes and destruction are reported to the root
+        screen.root_event_mask |= Xlib.X.SubstructureNotifyMask
+        screen.root.change_attributes( event_mask = screen.root_event_mask )
+
+        self.add( screen.get_client_list() )
+        logger.info("registry: tracking %d windows" % len( self.clientmap ) )
+
+
+    def add( self, windowids ):
+        '''start tracking a batch of clients'''
+        clients = self.screen.probe_clients( windowids )
+        frames = self.probe_frames( [ c.id for c in clients ] )
+
+        for c in clients:
+            c.frame = frames.get( c.id, c.id )
+            # same mask as Screen.watch_window, so the active window cache and the registry don't undo each other's selection
+            c.window.change_attributes( event_mask = Xlib.X.PropertyChangeMask | Xlib.X.StructureNotifyMask, onerror = Xlib.error.CatchError() )
+            self.clientmap[ c.id ] = c
+            self.frames[ c.frame ] = c.id
+            self.index( c )
+
+        for c in clients:
+            for callback in self.on_add:
+                callback( c )
+
+
+    def remove( self, windowid ):
+        '''stop tracking a client'''
+        c = self.clientmap.pop( windowid, None )
+        if ( c is None ):
+            return
+        self.unindex( c )
+        self.frames.pop( c.frame, None )
+        self.stale.discard( windowid )
+        for callback in self.on_remove:
+            callback( c )
+
+
+    def probe_frames( self, windowids ):
+        '''
+        Find the container of each window - its ancestor that is a child of the root.
+        The tree is walked one level at a time for the whole batch, so this costs a round trip per level of nesting
+        (usually one or two) rather than one per window per level.  Returns client id -> container id.
+        '''
+        d = self.screen.display.display
+        rootid = self.screen.root.id
+        frames = {}
+        current = dict( ( wid, wid ) for wid in windowids ) # client id -> window reached so far
+
+        while ( current ):
+            requests = [ ( cid, wid, Xlib.protocol.request.QueryTree( display = d, defer = True, window = wid ) ) for cid, wid in current.items() ]
+            current = {}
+            for cid, wid, req in requests:
+                try:
+                    parent = req.reply().parent.id
+                except Xlib.error.XError:
+                    continue
+                if ( parent == rootid or parent == Xlib.X.NONE ):
+                    frames[ cid ] = wid
+                else:
+                    current[ cid ] = parent
+
+        return frames
+
+
+    def refresh( self ):
+        '''probe the stale clients again - in one batch'''
+        if ( not self.stale ):
+            return
+        ids = [ wid for wid in self.stale if wid in self.clientmap ]
+        self.stale.clear()
+
+        fresh = dict( ( c.id, c ) for c in self.screen.probe_clients( ids ) )
+        for wid in ids:
+            old = self.clientmap[ wid ]
+            new = fresh.get( wid )
+            if ( new is None ):
+                continue # destroyed - DestroyNotify will follow
+            self.unindex( old )
+            new.window = old.window # keep the same window object, so anything attached to it survives
+            new.frame = old.frame
+            self.clientmap[ wid ] = new
+            self.index( new )
+
+
+    def is_panel( self, c ):
+        return any( t in self.panels for t in c.type )
+
+
+    def index( self, c ):
+        '''work out which monitor and grid cells a client covers, and add it to that monitor's cell index'''
+        c.monitor = self.screen.monitor_at( c.x + c.width // 2, c.y + c.height // 2 )
+        c.cells = None
+        if ( c.monitor is None or self.is_panel( c ) ):
+            return
+
+        lattice = self.screen.monitor[ c.monitor ].lattice
+        x0, x1 = lattice.span( 'x', c.x, c.width )
+        y0, y1 = lattice.span( 'y', c.y, c.height )
+        c.cells = ( x0, y0, x1, y1 )
+
+        cells = self.cells.setdefault( c.monitor, {} )
+        for cx in range( x0, x1 + 1 ):
+            for cy in range( y0, y1 + 1 ):
+                cells.setdefault( ( cx, cy ), set() ).add( c.id )
+
+
+    def unindex( self, c ):
+        if ( c.get( 'cells' ) is None ):
+            return
+        x0, y0, x1, y1 = c.cells
+        cells = self.cells.get( c.monitor, {} )
+        for cx in range( x0, x1 + 1 ):
+            for cy in range( y0, y1 + 1 ):
+                occupants = cells.get( ( cx, cy ) )
+                if ( occupants ):
+                    occupants.discard( c.id )
+                    if ( not occupants ):
+                        del cells[ ( cx, cy ) ]
+        c.cells = None
+
+
+    def reindex( self ):
+        '''rebuild the cell index - called when the monitor layout or a grid changes'''
+        self.cells = {}
+        for c in self.clientmap.values():
+            self.index( c )
+
+
+    def process_event( self, event ):
+        '''keep the registry current from an X event.  Called for every non-keyboard event.'''
+        if ( event.type == Xlib.X.ConfigureNotify ):
+            wid = self.frames.get( event.window.id )
+            if ( wid is None ):
+                return
+            c = self.clientmap[ wid ]
+            if ( c.frame == wid ):
+                # no reparenting - the event has the client's geometry, the frame extents are outside it
+                left, right, top, bottom = c.extents
+                rect = ( event.x - left, event.y - top, event.width + left + right, event.height + top + bottom )
+            else:
+                rect = ( event.x, event.y, event.width, event.height )
+            if ( rect != ( c.x, c.y, c.width, c.height ) ):
+                self.unindex( c )
+                c.x, c.y, c.width, c.height = rect
+                self.index( c )
+
+        elif ( event.type == Xlib.X.PropertyNotify ):
+            if ( event.window == self.screen.root ):
+                if ( event.atom == self.screen.atom._NET_CLIENT_LIST ):
+                    self.client_list_changed()
+            elif ( event.atom in self.watched and event.window.id in self.clientmap ):
+                self.stale.add( event.window.id )
+
+        elif ( event.type == Xlib.X.DestroyNotify ):
+            wid = event.window.id
+            self.remove( self.frames.get( wid, wid ) )
+
+        elif ( event.type == Xlib.X.ReparentNotify ):
+            # the WM moved a client into a new frame (or back to the root)
+            c = self.clientmap.get( event.window.id )
+            if ( c is not None ):
+                self.frames.pop( c.frame, None )
+                frame = self.probe_frames( [ c.id ] ).get( c.id, c.id )
+                c.frame = frame
+                self.frames[ frame ] = c.id
+                self.stale.add( c.id )
+
+
+    def client_list_changed( self ):
+        '''_NET_CLIENT_LIST changed - start tracking new clients, forget the ones that are gone'''
+        ids = self.screen.get_client_list()
+        current = set( ids )
+        for wid in [ wid for wid in self.clientmap if wid not in current ]:
+            self.remove( wid )
+        new = [ wid for wid in ids if wid not in self.clientmap ]
+        if ( new ):
+            self.add( new )
+
+
+    def get( self, windowid ):
+        self.refresh()
+        return self.clientmap.get( windowid )
+
+
+    def clients( self, panels=False ):
+        '''every tracked client, in _NET_CLIENT_LIST order.  Panels and desktop windows are left out unless panels is True.'''
+        self.refresh()
+        return [ c for c in self.clientmap.values() if panels or not self.is_panel( c ) ]
+
+
+    def neighbour( self, c, axis, steps, desktop=None ):
+        '''
+        Nearest client next to c on its monitor's grid - to the right/below if steps > 0, to the left/above if steps < 0.
+        Cells are scanned outwards from c's edge, first within c's own rows (or columns), then across the whole grid.
+        Ties go to the client whose middle is closest to c's.  Minimized clients are skipped.  Returns None if there's nothing
+        in that direction.
+        '''
+        self.refresh()
+        if ( c.cells is None ):
+            return None
+        if ( desktop is None ):
+            desktop = c.desktop
+
+        x0, y0, x1, y1 = c.cells
+        lattice = self.screen.monitor[ c.monitor ].lattice
+        cells = self.cells.get( c.monitor, {} )
+        hidden = self.screen.atom._NET_WM_STATE_HIDDEN # minimized windows, and HUD apps while they're hidden, are skipped
+
+        if ( axis == 'x' ):
+            lines = range( x1 + 1, lattice.gridX ) if steps > 0 else range( x0 - 1, -1, -1 )
+            bands = ( range( y0, y1 + 1 ), range( lattice.gridY ) )
+            key = lambda line, a: ( line, a )
+        else:
+            lines = range( y1 + 1, lattice.gridY ) if steps > 0 else range( y0 - 1, -1, -1 )
+            bands = ( range( x0, x1 + 1 ), range( lattice.gridX ) )
+            key = lambda line, a: ( a, line )
+
+        middle = ( c.x + c.width / 2.0, c.y + c.height / 2.0 )
+        def distance( other ):
+            return abs( other.x + other.width / 2.0 - middle[0] ) + abs( other.y + other.height / 2.0 - middle[1] )
+
+        for band in bands:
+            for line in lines:
+                found = set()
+                for a in band:
+                    found.update( cells.get( key( line, a ), () ) )
+                found.discard( c.id )
+                candidates = [ self.clientmap[ wid ] for wid in found ]
+                candidates = [ o for o in candidates if o.desktop in ( desktop, 0xFFFFFFFF, None ) and hidden not in o.state ]
+                if ( candidates ):
+                    return min( candidates, key=distance )
+
+        return None
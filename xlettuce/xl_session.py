@@ -0,0 +1,122 @@
+#!/usr/bin/python3
+
+# xl_session - save and restore window layouts.
+# A session records every managed window's class, title, desktop, monitor and grid cells (not raw pixels, so a session
+# still fits after a grid or resolution change).  Restoring sends every placement in one burst with a single flush.
+# Each entry also records the display name of the screen the window was on.
+
+import json, os, weakref
+import xutils
+import logging
+logger = logging.getLogger(__name__)
+
+
+class Session:
+    '''save/restore the layout of every window in _NET_CLIENT_LIST'''
+
+    def __init__( self, parent ):
+        self.parent = weakref.proxy(parent)
+
+
+    def get_clients( self, screen ):
+        '''current client windows on screen, minus panels and the desktop'''
+        return screen.registry.clients()
+
+
+    def save( self, path=None ):
+        '''write the current layout to the session file.  Returns the number of windows saved.'''
+        path = path or self.parent.snap.sessions.file
+
+        entries = []
+        for screen in self.parent.screens:
+            for c in self.get_clients( screen ):
+                # grid cells are taken on the monitor the middle of the window is on
+                if ( c.cells is None ):
+                    continue
+                x0, y0, x1, y1 = c.cells
+                entries.append( [ xutils.class_name( c.wmclass ), c.title, c.desktop, c.monitor, x0, y0, x1, y1, screen.name ] )
+
+        try:
+            with open( path + ".tmp", 'w' ) as f:
+                json.dump( entries, f, separators=(',', ':') )
+            os.replace( path + ".tmp", path )
+        except EnvironmentError as err:
+            logger.warning("couldn't save session %s: %s" % ( path, err ) )
+            return 0
+
+        logger.info("session: saved %d windows to %s" % ( len( entries ), path ) )
+        return len( entries )
+
+
+    def load( self, path ):
+        try:
+            with open( path ) as f:
+                return json.load( f )
+        except ( EnvironmentError, ValueError ) as err:
+            logger.warning("couldn't load session %s: %s" % ( path, err ) )
+            return []
+
+
+    def match( self, entries, clients ):
+        '''pair saved entries with current windows - class and title first, then class alone.  Each window is used once.'''
+        byclass = {}
+        for c in clients:
+            byclass.setdefault( xutils.class_name( c.wmclass ), [] ).append( c )
+
+        pairs = []
+        unmatched = []
+        for entry in entries:
+            candidates = byclass.get( entry[0], [] )
+            for c in candidates:
+                if ( c.title == entry[1] ):
+                    candidates.remove( c )
+                    pairs.append( ( entry, c ) )
+                    break
+            else:
+                unmatched.append( entry )
+
+        for entry in unmatched:
+            candidates = byclass.get( entry[0], [] )
+            if ( candidates ):
+                pairs.append( ( entry, candidates.pop( 0 ) ) )
+
+        return pairs
+
+
+    def restore( self, path=None ):
+        '''move every window that matches a saved entry back to its saved desktop and grid cells.  Returns the number placed.'''
+        path = path or self.parent.snap.sessions.file
+        entries = self.load( path )
+        if ( not entries ):
+            return 0
+
+        # windows go back to the display they were saved on - entries for a display that isn't open are skipped
+        byscreen = {}
+        for entry in entries:
+            byscreen.setdefault( entry[8], [] ).append( entry[:8] )
+
+        count = 0
+        for screen in self.parent.screens:
+            screenentries = byscreen.get( screen.name )
+            if ( not screenentries ):
+                continue
+            placements = []
+            for entry, c in self.match( screenentries, self.get_clients( screen ) ):
+                name, title, desktop, monitornum, x0, y0, x1, y1 = entry
+                if ( monitornum >= screen.monitor['count'] ):
+                    monitornum = 0
+
+                # clamp to the grid in case it has shrunk since the session was saved
+                lattice = screen.monitor[monitornum].lattice
+                x0 = min( x0, lattice.gridX - 1 )
+                x1 = min( max( x0, x1 ), lattice.gridX - 1 )
+                y0 = min( y0, lattice.gridY - 1 )
+                y1 = min( max( y0, y1 ), lattice.gridY - 1 )
+
+                placements.append( ( c, desktop, lattice.cell_rect( x0, y0, x1, y1 ) ) )
+
+            self.parent.place_clients( placements, screen )
+            count += len( placements )
+
+        logger.info("session: restored %d windows from %s" % ( count, path ) )
+        return count
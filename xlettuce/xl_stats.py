@@ -0,0 +1,98 @@
+#!/usr/bin/python3
+
+# xl_stats - per-action latency statistics.
+# Every dispatched hotkey action is timed from when the event loop picked its key event up to the final display flush.
+# Timings go into fixed size log-scale histograms, so memory stays constant however long Xlettuce runs, and p50/p95/p99
+# are read straight off the bucket counts.  The table is written to a stats file every few seconds.
+
+import math, os
+import logging
+logger = logging.getLogger(__name__)
+
+
+class Histogram:
+    '''
+    Log-scale latency histogram.  Bucket i counts durations between base * ratio**i and base * ratio**(i+1) seconds,
+    so every reported percentile is within one bucket width (about 9%) of the real value.  Durations outside the range
+    are counted in the first or last bucket.
+    '''
+
+    base = 1e-6 # 1 microsecond
+    ratio = 2 ** ( 1 / 8.0 ) # 8 buckets per doubling
+    buckets = 8 * 27 # 1us .. ~134s
+
+    def __init__( self ):
+        self.counts = [0] * self.buckets
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.scale = 1 / math.log( self.ratio )
+
+    def add( self, seconds ):
+        if ( seconds > self.base ):
+            i = min( self.buckets - 1, int( math.log( seconds / self.base ) * self.scale ) )
+        else:
+            i = 0
+        self.counts[i] += 1
+        self.count += 1
+        self.total += seconds
+        if ( seconds > self.max ):
+            self.max = seconds
+
+    def percentile( self, p ):
+        '''upper edge of the bucket holding the p'th percentile (p is 0-100), in seconds'''
+        if ( not self.count ):
+            return 0.0
+        rank = math.ceil( self.count * p / 100.0 )
+        seen = 0
+        for i, n in enumerate( self.counts ):
+            seen += n
+            if ( seen >= rank ):
+                return min( self.max, self.base * self.ratio ** ( i + 1 ) )
+        return self.max
+
+
+class Stats:
+    '''action name -> Histogram, written out to path every interval seconds'''
+
+    def __init__( self, loop, path, interval=10 ):
+        self.loop = loop
+        self.path = path
+        self.interval = interval
+        self.actions = {}
+        self.sections = [] # callables returning more text for the stats file - eg: X request counts
+        self.timer = self.loop.call_later( self.interval, self.tick )
+
+    def record( self, action, seconds ):
+        histogram = self.actions.get( action )
+        if ( histogram is None ):
+            histogram = self.actions[action] = Histogram()
+        histogram.add( seconds )
+
+    def report( self ):
+        '''the stats table as text - one line per action, times in milliseconds'''
+        lines = [ "%-20s %8s %9s %9s %9s %9s %9s" % ( "action", "count", "mean", "p50", "p95", "p99", "max" ) ]
+        for action in sorted( self.actions ):
+            h = self.actions[action]
+            lines.append( "%-20s %8d %9.3f %9.3f %9.3f %9.3f %9.3f" % ( action, h.count, 1000 * h.total / h.count,
+                          1000 * h.percentile( 50 ), 1000 * h.percentile( 95 ), 1000 * h.percentile( 99 ), 1000 * h.max ) )
+        return "\n".join( lines ) + "\n" + "".join( "\n" + section() for section in self.sections )
+
+    def tick( self ):
+        self.timer = self.loop.call_later( self.interval, self.tick )
+        self.write()
+
+    def write( self ):
+        if ( not self.actions ):
+            return
+        try:
+            with open( self.path + ".tmp", 'w' ) as f:
+                f.write( self.report() )
+            os.replace( self.path + ".tmp", self.path )
+        except EnvironmentError as err:
+            logger.warning("couldn't write stats file %s: %s" % ( self.path, err ) )
+
+    def stop( self ):
+        '''write the final numbers and stop the timer'''
+        self.timer.cancel()
+        self.write()
@@ -0,0 +1,107 @@
+#!/usr/bin/python3
+
+# xl_xcount - X request accounting.
+# Wraps a python-xlib connection to count the requests sent, the times Xlib had to stop and wait for a reply (round trips)
+# and the bytes written and read, so the cost of each hotkey action can be seen, and actions that wait on the X server
+# more than they should can be flagged.
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class CountingSocket:
+    '''socket stand-in that counts the bytes going through send() and recv() - everything else is passed through'''
+
+    def __init__( self, sock, counter ):
+        self.sock = sock
+        self.counter = counter
+
+    def send( self, data, *args ):
+        n = self.sock.send( data, *args )
+        self.counter.sent += n
+        return n
+
+    def recv( self, size, *args ):
+        data = self.sock.recv( size, *args )
+        self.counter.received += len( data )
+        return data
+
+    def __getattr__( self, name ):
+        return getattr( self.sock, name )
+
+
+class XCounter:
+    '''
+    Counts the traffic on one Xlib display connection.
+    Every request goes through the protocol display's send_request(), and Xlib only calls send_and_recv() with a request
+    serial when it has to block for that request's reply - so those calls are the round trips.  Deferred requests whose
+    replies arrive together cost one round trip between them.
+    Totals are attributed to actions with begin() / end(), and kept per action.
+    '''
+
+    def __init__( self, display, budget=0 ):
+        self.protocol = display.display
+        self.budget = budget # round trips an action may make before it's logged as a warning - 0 for no limit
+        self.requests = self.roundtrips = self.sent = self.received = 0
+        self.actions = {} # action -> [ count, requests, round trips, bytes sent, bytes received ]
+        self.install()
+
+
+    def install( self ):
+        protocol = self.protocol
+        send_request = protocol.send_request
+        send_and_recv = protocol.send_and_recv
+
+        def counted_send_request( request, wait_for_response ):
+            self.requests += 1
+            return send_request( request, wait_for_response )
+
+        def counted_send_and_recv( flush=None, event=None, request=None, recv=None ):
+            if ( request is not None ):
+                self.roundtrips += 1
+            return send_and_recv( flush=flush, event=event, request=request, recv=recv )
+
+        # instance attributes shadow the class's methods - uninstall() just deletes them again
+        protocol.send_request = counted_send_request
+        protocol.send_and_recv = counted_send_and_recv
+        protocol.socket = CountingSocket( protocol.socket, self )
+
+
+    def uninstall( self ):
+        protocol = self.protocol
+        del protocol.send_request
+        del protocol.send_and_recv
+        protocol.socket = protocol.socket.sock
+
+
+    def begin( self ):
+        '''totals so far - pass to end() once the action is done'''
+        return ( self.requests, self.roundtrips, self.sent, self.received )
+
+
+    def end( self, action, start ):
+        '''charge everything since begin() to action.  Returns ( requests, round trips, bytes sent, bytes received ).'''
+        used = ( self.requests - start[0], self.roundtrips - start[1], self.sent - start[2], self.received - start[3] )
+        totals = self.actions.get( action )
+        if ( totals is None ):
+            totals = self.actions[action] = [ 0, 0, 0, 0, 0 ]
+        totals[0] += 1
+        for i, n in enumerate( used ):
+            totals[i + 1] += n
+
+        if ( self.budget and used[1] > self.budget ):
+            logger.warning("%s made %d round trips to the X server (budget is %d) - %d requests, %d bytes sent, %d received" % ( action, used[1], self.budget, used[0], used[2], used[3] ) )
+        elif ( used[0] or used[1] ):
+            logger.debug("%s: %d requests, %d round trips, %d bytes sent, %d received" % ( ( action, ) + used ) )
+        return used
+
+
+    def report( self ):
+        '''per action averages as text'''
+        lines = [ "%-20s %8s %9s %9s %9s %9s" % ( "action", "count", "requests", "roundtrip", "sent", "received" ) ]
+        for action in sorted( self.actions ):
+            count, requests, roundtrips, sent, received = self.actions[action]
+            lines.append( "%-20s %8d %9.1f %9.1f %9.0f %9.0f" % ( action, count, requests / float( count ), roundtrips / float( count ),
+                                                                 sent / float( count ), received / float( count ) ) )
+        lines.append( "%-20s %8s %9d %9d %9d %9d" % ( "total", "", self.requests, self.roundtrips, self.sent, self.received ) )
+        return "\n".join( lines ) + "\n"
@@ -2,8 +2,11 @@
 # simple tiling grid manager - customizable grid.
 # disable capslock in keyboard settings.  Capslock key activates xlettuce
 
-import logging, Xlib, Xlib.display, os, subprocess, time, re
-import xutils, xl_config, psutil
+import time
+started = time.perf_counter() # imports are the first phase of --startup-trace
+
+import logging, Xlib, Xlib.display, os, sys, functools, collections
+import xutils, xl_config, xl_loop, xl_placement, xl_session, xl_layout, xl_launcher, xl_hud, xl_stats, xl_profile, xl_control
 
 # set up logging
 
@@ -18,6 +21,18 @@ class Xlettuce:
     
     # define cursor keys
     cursorkeys =  [111, 113, 114, 116]
+
+    # cursor keycode -> ( lattice axis, direction ) - up, left, right, down
+    cursorsteps = { 111: ('y', -1), 113: ('x', -1), 114: ('x', 1), 116: ('y', 1) }
+
+    # pack every window on the current monitor onto its grid - space
+    packkey = 65
+
+    # cursor key actions whose auto-repeats are merged into one multi-cell step - see coalesce_repeats
+    repeatable = frozenset( ( "movewin", "sizewin_tl", "sizewin_br" ) )
+
+    # modifiers that distinguish hotkeys - shift, control, alt (mod1) and super (mod4).  Lock, numlock, etc are ignored.
+    modmask = Xlib.X.ShiftMask | Xlib.X.ControlMask | Xlib.X.Mod1Mask | Xlib.X.Mod4Mask
     
     # initialize hotkey map - maps event codes to keyboard grid locations
     tilekeymap = { 10:(0, 0),  11: (1, 0),  12: (2, 0),  13: (3, 0),  14: (4, 0),  15: (5, 0), 16: (6, 0), 17: (7, 0), 18: (8, 0), 19: (9, 0),
@@ -30,28 +45,31 @@ class Xlettuce:
                      83:3, 84:4, 85:5,
                      87:6, 88:7, 89:8}
 
-    # dict with keycode as key, value is a tuple made up of the modmap, the command, then followed by arbitrary number of args
-    # this is used to enable hotkey shortcuts when xlettuce detects
-    hotkeys = {67: (0, "~/Scripts/setWacom.sh", "map1", "PAD9x12"),
-               68: (0, "~/Scripts/setWacom.sh", "map2", "PAD9x12"),
-               69: (0, "~/Scripts/setWacom.sh", "map3", "PAD9x12") }
+    # function key keycode -> launcher name in the [LAUNCHERS] section.  SHIFT + the key runs "SHIFT+" + the name.
+    launcherkeymap = { 67: "f1", 68: "f2", 69: "f3", 70: "f4", 71: "f5", 72: "f6", 73: "f7", 74: "f8", 75: "f9", 76: "f10", 95: "f11", 96: "f12" }
     
     
-    def __init__(self):
-        """Initializes the tiling grid.  Sets the screen area, grid size, etc.  Defaults to primary monitor at 0,0."""
-        
-        self.sleeptime=0.05
-        
-        self.trigger_keycode = 66 # caps lock
-        
+    def __init__(self, startup_trace=False):
+        """Initializes the tiling grid.  Sets the screen area, grid size, etc.  Defaults to primary monitor at 0,0.
+        startup_trace prints how long each phase of startup took."""
+
+        # time every phase of startup - the total is checked against Startup_Budget
+        self.trace = xl_profile.StartupTrace( started )
+        self.trace.mark("imports")
+
         # load config
         self.conf = xl_config.xl_config(self)
+        self.snap = self.conf.snap # typed, read-only settings for the hot paths
+        self.trace.mark("config")
+
+        self.trigger_keycode = self.snap.general.trigger_key # 66 = caps lock
         
         # start logger
         logging.getLogger( __name__ )
-        logging.basicConfig(filename=self.conf.get("GENERAL", "Log_File"), level=self.conf.get("GENERAL", "Log_Level"),  format='%(asctime)s %(message)s')
+        logging.basicConfig(filename=self.snap.general.log_file, level=self.snap.general.log_level,  format='%(asctime)s %(message)s')
         logging.getLogger().addHandler(logging.StreamHandler()) # also output log msgs to stdout
         logging.info('Xlettuce launched')
+        self.trace.mark("logging")
 
 
 
@@ -60,107 +78,409 @@ class Xlettuce:
         self.isActive = False # initialize var that tracks capslock button state - held down = isActive
         self.firstX = -1 # initialize var that tracks tiling destination
         self.firstY = -1 # initialize var that tracks tiling destination
+        self.firstScreen = None # screen the first tiling key was pressed on
         self.shift = False # state of shift key modifier
         self.ctrl = False # state of left ctrl key
         self.alt = False # state of left alt key
         self.modnone = True # if no mods are pressed, this is true
         self.currentMonitor = 0 # which monitor are we working on
         
-        #probe X for info about screen layout, return screen object
-        self.screen = xutils.Screen(self)
+        #probe X for info about screen layout - one Screen, with its own connection, per display/screen in the config
+        self.screen = None
+        self.screens = self.open_screens( self.snap.general.displays )
 
-        #alias xlib objects
-        self.display = self.screen.display
-        self.root = self.screen.root
-        
-        #set key grabs for all possible modifier combinations of the Xlettuce trigger key - 66 is CAPS_LOCK
-        self.screen.set_grab_trigger(66)
+        #alias xlib objects - these follow whichever screen the event being handled came from (see use_screen)
+        self.use_screen( self.screens[0] )
+
+        for screen in self.screens:
+            #set key grabs for all possible modifier combinations of the Xlettuce trigger key - 66 is CAPS_LOCK
+            screen.set_grab_trigger(self.trigger_keycode)
+
+            #set number of desktops - 9 (3x3) is default - best for numberpad navigation
+            screen.set_num_desktops(9)
 
-        #set number of desktops - 9 (3x3) is default - best for numberpad navigation
-        self.screen.set_num_desktops(9)
+        # compile the hotkey table
+        self.build_dispatch()
+        self.trace.mark("grabs, dispatch")
         
-        # main loop
-        while True:
-            self.e = xutils.KeyEvent(self.display.next_event(), self)
+        # main loop - wait on the X connection rather than polling it
+        self.loop = xl_loop.EventLoop()
+
+        # learned per-application placement corrections
+        self.placement = xl_placement.PlacementCache( self.snap.general.placement_cache, self.loop )
+
+        # saved window layouts
+        self.session = xl_session.Session( self )
+        self.trace.mark("placement, session")
+
+        # runs [LAUNCHERS] commands
+        self.launcher = xl_launcher.Launcher( self.loop )
+
+        # [HUD] apps - started once, then shown and hidden
+        self.hud = xl_hud.Hud( self )
+        self.trace.mark("launcher, hud")
+
+        # optional per-action latency histograms - None when turned off, so the hot path only pays for one test
+        self.stats = None
+        self.arrival = 0 # when the event loop picked up the current batch of events
+        self.held = collections.deque() # events read ahead by coalesce_repeats that weren't repeats - handled next
+        self.set_stats()
+
+        # SIGUSR1 toggles profiling of event dispatch
+        self.profiler = xl_profile.Profiler( self.loop, os.path.dirname( os.path.abspath( self.snap.general.log_file or "xlettuce.log" ) ) )
+        self.trace.mark("stats, profiler")
+
+        for screen in self.screens:
+            self.loop.add_reader( screen.display.fileno(), functools.partial( self.process_x_events, screen ), screen.display.pending_events )
+
+        # local socket for xlettuce-ctl and scripts
+        self.control = None
+        self.set_control()
+        self.trace.mark("control socket")
+
+        # pick up edits to the config file without a restart
+        self.confwatcher = xl_loop.FileWatcher( self.loop, self.conf.configfile, self.reload_config )
+        self.trace.mark("config watcher")
+
+        # everything that didn't need a reply is still queued - grabs, event masks, desktops - send it all at once
+        for screen in self.screens:
+            screen.display.flush()
+        self.trace.mark("flush")
+        self.check_startup( startup_trace )
+
+        self.loop.run()
+
+
+    def check_startup( self, startup_trace ):
+        '''log the startup time, and warn if it went over budget'''
+        total = 1000 * self.trace.total()
+        if ( startup_trace ):
+            print( self.trace.report() )
+        budget = self.snap.general.startup_budget
+        if ( budget and total > budget ):
+            logging.warning("startup took %.1f ms, over the %d ms Startup_Budget - run with --startup-trace to see where it went" % ( total, budget ) )
+        else:
+            logging.info("started in %.1f ms" % total )
 
-            if ( self.e.is_mapping_notify ):
-                # mapping has changed.  update the keymap cache, then skip to next event.
-                self.display.refresh_keyboard_mapping(self.e.event)
-                time.sleep(self.sleeptime)
-                continue
 
+    def reload_config( self ):
+        '''the config file changed - swap in the new settings, and rebuild only the state that depends on values that changed'''
+        old = self.snap
+        snap = self.conf.reload()
+        if ( snap is None or snap == old ):
+            return
+
+        self.snap = snap
+        logging.info('Config reloaded')
+
+        if ( snap.general.log_level != old.general.log_level ):
+            logging.getLogger().setLevel( snap.general.log_level )
+
+        if ( snap.general.trigger_key != old.general.trigger_key ):
+            for screen in self.screens:
+                screen.ungrab_trigger( self.trigger_keycode )
+                screen.set_grab_trigger( snap.general.trigger_key )
+            self.trigger_keycode = snap.general.trigger_key
+            self.isActive = False
+
+        if ( snap.general.displays != old.general.displays ):
+            logging.warning("Displays changed - restart Xlettuce to connect to the new list")
+
+        if ( ( snap.general.stats_file, snap.general.stats_interval ) != ( old.general.stats_file, old.general.stats_interval ) ):
+            self.set_stats()
+
+        if ( ( snap.general.count_requests, snap.general.round_trip_budget ) != ( old.general.count_requests, old.general.round_trip_budget ) ):
+            for screen in self.screens:
+                screen.set_xcount( snap.general.count_requests, snap.general.round_trip_budget )
+
+        if ( snap.general.control_socket != old.general.control_socket ):
+            self.set_control()
+
+        if ( snap.hud != old.hud ):
+            self.hud.configure( snap.hud.apps )
+
+        for screen in self.screens:
+            for i in range( screen.monitor['count'] ):
+                if ( snap.monitors[i] != old.monitors[i] ):
+                    screen.rebuild_monitor( i )
+
+        self.build_dispatch()
+        for screen in self.screens:
+            screen.display.flush()
 
+
+    def open_screens( self, names ):
+        '''connect to each display name ( None for $DISPLAY ) - a display that can't be opened is skipped, unless it's the only one'''
+        screens = []
+        for name in names:
             try:
-                self.activeWindow = self.screen.get_active_window()
-                self.currentMonitor = self.screen.get_current_monitor( self.e.event )
-                
-                # process event
-                self.e.get_mods()
-                self.e.get_action()
-                
-                logging.debug(self.e.action)
-
-                if ( self.e.action == False ): 
-                    # key event didn't match any hotkey - skip to next event
-                    time.sleep(self.sleeptime)
-                    continue
+                screens.append( xutils.Screen( self, name, len( screens ) ) )
+            except Xlib.error.DisplayError as err:
+                if ( len( names ) == 1 ):
+                    raise
+                logging.warning("couldn't open display %s: %s" % ( name, err ) )
+        if ( not screens ):
+            raise SystemExit( "Xlettuce: couldn't open any of the displays %s" % ", ".join( names ) )
+        return screens
+
+
+    def use_screen( self, screen ):
+        '''point screen, display and root at the screen whose events or commands are being handled'''
+        if ( screen is not self.screen ):
+            self.screen = screen
+            self.display = screen.display
+            self.root = screen.root
+
+
+    def set_stats( self ):
+        '''start or stop collecting latency stats, to match the config'''
+        general = self.snap.general
+        if ( self.stats ):
+            if ( general.stats_file == self.stats.path and general.stats_interval == self.stats.interval ):
+                return
+            self.stats.stop()
+            self.stats = None
+        if ( general.stats_file ):
+            self.stats = xl_stats.Stats( self.loop, general.stats_file, general.stats_interval )
+            self.stats.sections.append( self.xcount_report )
+
+
+    def set_control( self ):
+        '''open, move or close the control socket, to match the config'''
+        path = xl_control.socket_path( self.snap.general.control_socket )
+        if ( self.control ):
+            if ( path == self.control.path ):
+                return
+            self.control.stop()
+            self.control = None
+        if ( path ):
+            self.control = xl_control.ControlServer( self, self.loop, path )
+
+
+    def xcount_report( self ):
+        '''X request counts for the stats file - one table per screen'''
+        counted = [ screen for screen in self.screens if screen.xcount ]
+        if ( len( self.screens ) == 1 ):
+            return "".join( screen.xcount.report() for screen in counted )
+        return "\n".join( "display %s\n%s" % ( screen.name, screen.xcount.report() ) for screen in counted )
+
+
+    def process_x_events( self, screen ):
+        '''drain every event Xlib has queued or can read without blocking on screen's connection, then return to the event loop'''
+        self.use_screen( screen )
+        self.arrival = time.perf_counter()
+        xcount = self.screen.xcount
+        profiler = self.profiler if self.profiler.active else None
+        while True:
+            event = self.next_pending()
+            if ( event is None ):
+                break
+            if ( xcount is None and profiler is None ):
+                self.handle_event( event )
+                continue
+
+            # instrumented dispatch
+            if ( xcount ):
+                start = xcount.begin()
+            if ( profiler ):
+                profiler.enable()
+            self.handle_event( event )
+            label = self.event_label( event )
+            if ( profiler ):
+                profiler.collect( label )
+            if ( xcount ):
+                xcount.end( label, start )
+
+
+    def event_label( self, event ):
+        '''what the last handled event is accounted as - its hotkey action, or unbound_key / x_events'''
+        if ( self.action ):
+            return self.action
+        return "unbound_key" if event.type in ( Xlib.X.KeyPress, Xlib.X.KeyRelease ) else "x_events"
+
+
+    def handle_event( self, event ):
+        '''process a single X event'''
+        self.action = None # the hotkey action it triggered, if any
+        if ( event.type not in ( Xlib.X.KeyPress, Xlib.X.KeyRelease, Xlib.X.MappingNotify ) ):
+            # window/property notifications keep the screen's caches current
+            self.screen.process_event( event )
+            if ( event.type == Xlib.X.ConfigureNotify ):
+                self.placement.observe( event )
+            return
+
+        self.e = xutils.KeyEvent(event, self)
+
+        if ( self.e.is_mapping_notify ):
+            # mapping has changed.  update the keymap cache and hotkey table, then skip to next event.
+            self.display.refresh_keyboard_mapping(self.e.event)
+            self.build_dispatch()
+            return
+
+        try:
+            self.activeWindow = self.screen.get_active_window()
+            self.currentMonitor = self.screen.get_current_monitor( self.e.event )
             
-                elif ( self.e.action == "trigger_press" ): 
-                    self.screen.grab_keyboard()
-                    self.isActive=True; 
-                    self.firstX = self.firstY = -1 # reset moveto X Y values
+            # process event
+            self.e.get_mods()
+            self.action = self.e.get_action()
+            
+            logging.debug(self.e.action)
+
+            if ( self.e.action == False ): 
+                # key event didn't match any hotkey - skip to next event
+                return
+        
+            elif ( self.e.action == "trigger_press" ): 
+                self.screen.grab_keyboard()
+                self.isActive=True; 
+                self.firstX = self.firstY = -1 # reset moveto X Y values
+
+            elif ( self.e.action == "trigger_release" ):
+                self.screen.ungrab_keyboard()
+                self.isActive=False
+                self.firstX = self.firstY = -1 # reset moveto X Y values
+
+            elif ( not self.isActive ):
+                return
+
+            elif ( self.e.action in self.repeatable ):
+                # held cursor key - catch up with every repeat already queued in one step
+                self.e.handler( self.e.keycode, self.coalesce_repeats( event ) )
+
+            else:
+                # run the hotkey's handler, looked up in the dispatch table by get_action
+                self.e.handler( self.e.keycode )
+
+
+        except AttributeError as err:
+            logging.debug("AttributeError: State - caught = " + str(err) )
+            #logging.debug("activewininfo = " + str(self.activeWindow.info) )
+
+        except Xlib.error.BadDrawable as err:
+            logging.debug("error.BadDrawable: State - caught = " + str(err) )
+            #logging.debug("activewininfo = " + str(self.activeWindow.info) )
+
+        # trigger grabs/ungrabs are sent asynchronously - push them out now rather than waiting for the next request
+        self.display.flush()
+
+        if ( self.stats and self.e.action ):
+            # from the loop picking the key event up to the last request leaving
+            self.stats.record( self.e.action, time.perf_counter() - self.arrival )
+
+
+    def next_pending( self ):
+        '''the next event to handle - read ahead ones first, then whatever Xlib has or can read without blocking - or None'''
+        if ( self.held ):
+            return self.held.popleft()
+        if ( self.display.pending_events() ):
+            return self.display.next_event()
+        return None
+
+
+    def coalesce_repeats( self, event ):
+        '''
+        Take the auto-repeats of a key press off the front of the pending events, and return how many presses there were
+        in total.  A held key repeats as KeyRelease/KeyPress pairs (or bare KeyPresses with detectable auto-repeat on) with
+        the same keycode and modifiers - once handling falls behind they queue up, and are applied as one step instead
+        of one configure each.  Anything else ends the run, and is put back in front of the rest, so events are still
+        handled in order.
+        '''
+        count = 1
+        while True:
+            run = []
+            press = self.next_pending()
+            if ( press is not None and press.type == Xlib.X.KeyRelease and press.detail == event.detail ):
+                run.append( press )
+                press = self.next_pending()
+            if ( press is not None ):
+                run.append( press )
+            if ( press is None or press.type != Xlib.X.KeyPress or press.detail != event.detail or press.state != event.state ):
+                self.held.extendleft( reversed( run ) )
+                break
+            count += 1
+
+        if ( count > 1 ):
+            logging.debug("coalesced %d repeats of %s" % ( count, self.e.action ) )
+        return count
+
+
+    def build_dispatch( self ):
+        '''Compile the hotkey dispatch table from the key maps and config.
+        Maps (keycode, modifier mask) -> Bunch( action, handler, predicate ).  handler is called with the keycode,
+        predicate (if set) must return True for the handler to run - eg: to skip window actions when the desktop is active.
+        Rebuild whenever the config or keyboard mapping changes.
+        '''
+        dispatch = {}
+        anymods = [ m for m in range( self.modmask + 1 ) if ( m & ~self.modmask ) == 0 ]
+
+        def bind( keycode, mods, action, handler, predicate=None ):
+            # earlier bindings win, same as the order of checks in the old elif ladder
+            for m in mods:
+                dispatch.setdefault( ( keycode, m ), xutils.Bunch( action=action, handler=handler, predicate=predicate ) )
 
-                elif ( self.e.action == "trigger_release" ):
-                    self.screen.ungrab_keyboard()
-                    self.isActive=False
-                    self.firstX = self.firstY = -1 # reset moveto X Y values
+        for n, monitor in enumerate( self.snap.monitors ):
+            keycode = monitor.hotkey
+            if ( keycode ):
+                bind( keycode, anymods, "set_monitor_%d" % n, functools.partial( self.set_monitor, n ) )
 
-                elif ( not self.isActive ):
-                    time.sleep(self.sleeptime)
-                    continue
+        for n, app in enumerate( self.snap.hud.apps ):
+            if ( app.hotkey and app.command ):
+                bind( app.hotkey, ( 0, ), "hud_%d" % n, functools.partial( self.hud_toggle, n ) )
 
-                elif ( self.e.action == "set_monitor_0" ):
-                    self.currentMonitor = 0
+        for keycode in self.tilekeymap:
+            bind( keycode, ( 0, Xlib.X.ShiftMask ), "tilekey", self.tilekey, self.valid_window )
 
-                elif ( self.e.action == "set_monitor_1" ):
-                    self.currentMonitor = 1
+        for keycode in self.desktopkeymap:
+            bind( keycode, anymods, "desktopkey", self.desktopkey )
 
-                elif ( self.e.action == "set_monitor_2" ):
-                    self.currentMonitor = 2
+        if ( self.snap.sessions.save_hotkey ):
+            bind( self.snap.sessions.save_hotkey, ( Xlib.X.ControlMask, ), "session_save", self.session_save )
+        if ( self.snap.sessions.restore_hotkey ):
+            bind( self.snap.sessions.restore_hotkey, ( Xlib.X.ControlMask, ), "session_restore", self.session_restore )
 
-                elif ( self.e.action == "set_monitor_3" ):
-                    self.currentMonitor = 3
+        bind( self.packkey, ( 0, ), "pack", self.pack_monitor )
 
-                elif ( self.e.action == "tilekey" ):
-                    # one of the tiling position hotkeys was pressed
-                    self.tilekey( self.e.keycode )
+        for keycode, name in self.launcherkeymap.items():
+            for mods, launcher in ( ( 0, name ), ( Xlib.X.ShiftMask, "SHIFT+" + name ) ):
+                if ( self.snap.launchers.get( launcher ) ):
+                    bind( keycode, ( mods, ), "launch", functools.partial( self.launch, launcher ) )
 
-                elif ( self.e.action == "desktopkey" ):
-                    # one of the virtual desktop hotkeys was pressed
-                    self.desktopkey( self.e.keycode )
+        for keycode in self.cursorkeys:
+            bind( keycode, ( 0, ), "movewin", self.movewin, self.valid_window )
+            bind( keycode, ( Xlib.X.ShiftMask, ), "sizewin_tl", self.sizewinTL, self.valid_window )
+            bind( keycode, ( Xlib.X.ControlMask, ), "sizewin_br", self.sizewinBR, self.valid_window )
+            bind( keycode, ( Xlib.X.Mod1Mask, ), "focus_neighbour", self.focus_neighbour, self.valid_window )
+            bind( keycode, ( Xlib.X.Mod1Mask | Xlib.X.ShiftMask, ), "swap_neighbour", self.swap_neighbour, self.valid_window )
 
-                elif ( self.e.action == "movewin" ):
-                    # HOTKEY+Cursor, no mods = move window on grid
-                    self.movewin(self.e.keycode)
+        self.dispatch = dispatch
 
-                elif ( self.e.action == "sizewin_tl" ):
-                    # Shift+HOTKEY+cursor=resize top left
-                    self.sizewinTL(self.e.keycode)
 
-                elif ( self.e.action == "sizewin_br" ):
-                    # Ctrl+HOTKEY+cursor=resize bottom right
-                    self.sizewinBR(self.e.keycode)
-                    
+    def set_monitor( self, monitornum, keycode=None ):
+        '''monitor hotkey - tile onto a specific monitor'''
+        self.currentMonitor = monitornum
 
-            except AttributeError as err:
-                logging.debug("AttributeError: State - caught = " + str(err) )
-                #logging.debug("activewininfo = " + str(self.activeWindow.info) )
 
-            except Xlib.error.BadDrawable as err:
-                logging.debug("error.BadDrawable: State - caught = " + str(err) )
-                #logging.debug("activewininfo = " + str(self.activeWindow.info) )
+    def hud_toggle( self, n, keycode=None ):
+        '''HUD hotkey - show or hide a HUD app'''
+        self.hud.toggle( n )
 
-            time.sleep(self.sleeptime)
+
+    def launch( self, name, keycode=None ):
+        '''launcher hotkey - run the command configured for this launcher, on the screen the hotkey was pressed on'''
+        argv = self.snap.launchers.get( name )
+        if ( argv ):
+            self.launcher.spawn( argv, env=self.screen.environ() )
+
+
+    def session_save( self, keycode=None ):
+        '''session hotkey - save the layout of every window'''
+        self.session.save()
+
+
+    def session_restore( self, keycode=None ):
+        '''session hotkey - put every window back where the saved session had it'''
+        self.session.restore()
 
 
     def valid_window( self ):
@@ -172,17 +492,6 @@ class Xlettuce:
             return False
 
     
-    def is_onscreen(self, x, y):
-        '''check if a given coordinate is within the bounds of the monitor's workarea'''
-        if ( x >= self.screen.monitor[self.currentMonitor].workarea.screenX and
-            x <= self.screen.monitor[self.currentMonitor].workarea.screenX + self.screen.monitor[self.currentMonitor]['width'] and
-            y >= self.screen.monitor[self.currentMonitor].workarea.screenY and
-            y <= self.screen.monitor[self.currentMonitor].workarea.screenY + self.screen.monitor[self.currentMonitor]['height'] ):
-            
-            return True
-        else:
-            return False
-    
     def is_ongrid(self, x, y):
         '''check if a pair of coordinates are on the valid tilekey grid for the current monitor'''
         if ( x<0 or y<0 or
@@ -191,140 +500,119 @@ class Xlettuce:
             return False
         else:
             return True
-        
-    def get_grid_screenX(self, x):
-        '''gets the screen X coordinate for a given tilekey grid coordinate'''
-        screenX = self.screen.monitor[self.currentMonitor].workarea.screenX + ( self.screen.monitor[self.currentMonitor].lattice.slotWidth * x )
-        return screenX
-        
-    def get_grid_screenY(self, y):
-        '''gets the screen X coordinate for a given tilekey grid coordinate'''
-        screenY = self.screen.monitor[self.currentMonitor].workarea.screenY + ( self.screen.monitor[self.currentMonitor].lattice.slotHeight * y )
-        return screenY
-                
-    def get_gridmoveY(self, dir):
-        '''calculate new y position after a gridmove.
-        dir = "up" or "down"'''
-        px_offset={"up":-30, "down":30}
-        grid_offset={"up":0, "down":1}
-        newY = self.screen.monitor[self.currentMonitor].workarea.screenY + ( ( self.activeWindow.info['containergeom'].y - self.screen.monitor[self.currentMonitor].workarea.screenY + px_offset[dir] ) // self.screen.monitor[self.currentMonitor].lattice.slotHeight + grid_offset[dir] ) * self.screen.monitor[self.currentMonitor].lattice.slotHeight
-        if newY < self.screen.panel_top :
-            newY = self.screen.panel_top
-        if newY > self.screen.avail_height + self.screen.panel_top:
-            newY = self.screen.avail_height + self.screen.panel_top - self.activeWindow.info['fullheight']
-        
-        return newY
-        
-    def get_gridmoveX(self, dir):
-        '''calculate new x position after a gridmove.
-        dir = "left" or "right"'''
-        px_offset={"left":-30, "right":30}
-        grid_offset={"left":0, "right":1}
-        newX = self.screen.monitor[self.currentMonitor].workarea.screenX + ( ( self.activeWindow.info['containergeom'].x - self.screen.monitor[self.currentMonitor].workarea.screenX + px_offset[dir] ) // self.screen.monitor[self.currentMonitor].lattice.slotWidth + grid_offset[dir] ) * self.screen.monitor[self.currentMonitor].lattice.slotWidth
-        if newX < self.screen.panel_top :
-            newX = self.screen.monitor[self.currentMonitor].workarea.screenX
-        if newX > self.screen.monitor[self.currentMonitor].workarea.width + self.screen.monitor[self.currentMonitor].workarea.screenX :
-            newX = self.screen.monitor[self.currentMonitor].workarea.width + self.screen.monitor[self.currentMonitor].workarea.screenX - self.screen.monitor[self.currentMonitor].lattice.slotWidth
-        
-        return newX
 
-    def get_gridresize_height(self, dir, corner="BR"):
-        '''calculate new height after a gridmove.'''
-        if (corner=="TL"):
-            px_offset={"up":30, "down":-30}
-            grid_offset={"up":1, "down":0}
-        else:
-            px_offset={"up":-30, "down":30}
-            grid_offset={"up":0, "down":1}
-
-        height = ( ( self.activeWindow.info['containergeom'].height + px_offset[dir] ) // self.screen.monitor[self.currentMonitor].lattice.slotHeight + grid_offset[dir] ) * self.screen.monitor[self.currentMonitor].lattice.slotHeight
-        if height < self.screen.monitor[self.currentMonitor].lattice.slotHeight :
-            height = self.screen.monitor[self.currentMonitor].lattice.slotHeight
-        if height > self.screen.monitor[self.currentMonitor].height :
-            height = self.screen.monitor[self.currentMonitor].height
-        if height+self.activeWindow.info['containergeom'].y > self.screen.monitor[self.currentMonitor].workarea.height + self.screen.monitor[self.currentMonitor].workarea.screenY:
-            height = self.screen.monitor[self.currentMonitor].height - self.activeWindow.info['containergeom'].y
-        
-        return height
-        
-    def get_gridresize_width(self, dir, corner="BR"):
-        '''calculate new width after a gridmove.'''
-        if (corner=="TL"):
-            px_offset={"left":30, "right":-30}
-            grid_offset={"left":1, "right":0}
-        else:
-            px_offset={"left":-30, "right":30}
-            grid_offset={"left":0, "right":1}
-            
-        width = ( ( self.activeWindow.info['containergeom'].width + px_offset[dir] ) // self.screen.monitor[self.currentMonitor].lattice.slotWidth + grid_offset[dir] ) * self.screen.monitor[self.currentMonitor].lattice.slotWidth
-        if width < self.screen.monitor[self.currentMonitor].lattice.slotWidth :
-            width = self.screen.monitor[self.currentMonitor].lattice.slotWidth
-        if width > self.screen.monitor[self.currentMonitor].width :
-            width = self.screen.monitor[self.currentMonitor].width
-        if width+self.activeWindow.info['containergeom'].x > self.screen.monitor[self.currentMonitor].workarea.width + self.screen.monitor[self.currentMonitor].workarea.screenX:
-            width = self.screen.monitor[self.currentMonitor].width - self.activeWindow.info['containergeom'].x
-        
-        return width
-        
+
+    def get_lattice( self ):
+        '''tiling lattice of the current monitor'''
+        return self.screen.monitor[self.currentMonitor].lattice
+
         
-    def movewin(self,  keycode):
-        '''move active window according to grid using cursor keys.'''
+    def movewin(self,  keycode, count=1):
+        '''move active window according to grid using cursor keys - count cells at once.'''
 
         newx = -1
         newy = -1
+        geom = self.activeWindow.info['containergeom']
+        axis, steps = self.cursorsteps[keycode]
+        steps *= count
 
-        if ( keycode == 111 ): #cursor up
-            newy = self.get_gridmoveY('up')
-        if ( keycode == 116 ): #cursor down
-            newy = self.get_gridmoveY('down')
-        if ( keycode == 113 ): #cursor left
-            newx = self.get_gridmoveX('left')
-        if ( keycode == 114 ): #cursor right
-            newx = self.get_gridmoveX('right')
+        if ( axis == 'x' ):
+            newx = self.get_lattice().move( 'x', geom.x, steps )
+        else:
+            newy = self.get_lattice().move( 'y', geom.y, steps )
             
         self.configureWin(newx, newy, -1, -1)
 
 
-    def sizewinBR(self,  keycode):
-        '''resize active window according to grid using cursor keys. - change bottom and right edge'''
+    def sizewinBR(self,  keycode, count=1):
+        '''resize active window according to grid using cursor keys. - change bottom and right edge, count cells at once'''
 
         width = -1
         height = -1
+        geom = self.activeWindow.info['containergeom']
+        axis, steps = self.cursorsteps[keycode]
+        steps *= count
 
-        if ( keycode == 111 ): #cursor up
-            height = self.get_gridresize_height('up')
-        if ( keycode == 116 ): #cursor down
-            height = self.get_gridresize_height('down')
-        if ( keycode == 113 ): #cursor left
-            width = self.get_gridresize_width('left')
-        if ( keycode == 114 ): #cursor right
-            width = self.get_gridresize_width('right')
+        if ( axis == 'x' ):
+            width = self.get_lattice().resize_end( 'x', geom.x, geom.x + geom.width, steps ) - geom.x
+        else:
+            height = self.get_lattice().resize_end( 'y', geom.y, geom.y + geom.height, steps ) - geom.y
 
         self.configureWin(-1, -1, width, height)
 
 
-    def sizewinTL(self,  keycode):
-        '''resize active window according to grid using cursor keys. - change top and left edge'''
+    def get_neighbour( self, keycode ):
+        '''( active client, nearest client in the cursor key's direction ) from the window registry - either can be None'''
+        registry = self.screen.registry
+        active = registry.get( self.activeWindow.id )
+        if ( active is None ):
+            return ( None, None )
+        axis, steps = self.cursorsteps[keycode]
+        return ( active, registry.neighbour( active, axis, steps ) )
+
+
+    def focus_neighbour( self, keycode ):
+        '''activate the nearest window in the cursor key's direction'''
+        active, neighbour = self.get_neighbour( keycode )
+        if ( neighbour is None ):
+            return
+        # source indication 2 - pager/tool, so the WM doesn't apply focus stealing prevention
+        self.screen.send_event( neighbour.window, self.screen.atom._NET_ACTIVE_WINDOW, [ 2, Xlib.X.CurrentTime, self.activeWindow.id ] )
+
+
+    def swap_neighbour( self, keycode ):
+        '''swap the grid rectangles of the active window and the nearest window in the cursor key's direction'''
+        active, neighbour = self.get_neighbour( keycode )
+        if ( neighbour is None ):
+            return
+        lattice = self.screen.monitor[ active.monitor ].lattice
+        self.place_clients( [ ( active, None, lattice.cell_rect( *neighbour.cells ) ),
+                              ( neighbour, None, lattice.cell_rect( *active.cells ) ) ] )
+
+
+    def pack_monitor( self, keycode=None ):
+        '''pack every visible window on the current monitor and desktop onto the monitor's grid, without overlaps'''
+        registry = self.screen.registry
+        desktop = self.screen.get_current_desktop()
+        lattice = self.get_lattice()
+
+        windows = []
+        clients = {}
+        for c in registry.clients():
+            if ( c.monitor != self.currentMonitor or c.cells is None or c.desktop not in ( desktop, 0xFFFFFFFF, None ) ):
+                continue
+            if ( self.screen.atom._NET_WM_STATE_HIDDEN in c.state ):
+                continue # minimized
+            clients[ c.id ] = c
+            windows.append( ( c.id, c.cells, xl_layout.min_size( c ) ) )
+
+        placements = []
+        for wid, cells in xl_layout.pack( lattice, windows ):
+            c = clients[ wid ]
+            rect = lattice.cell_rect( *cells )
+            if ( rect != ( c.x, c.y, c.width, c.height ) ):
+                placements.append( ( c, None, rect ) )
+
+        logging.debug("pack: %d windows, %d moved" % ( len( windows ), len( placements ) ) )
+        self.place_clients( placements )
+
+
+    def sizewinTL(self,  keycode, count=1):
+        '''resize active window according to grid using cursor keys. - change top and left edge, count cells at once'''
         newx = -1
         newy = -1
         width = -1
         height = -1
+        geom = self.activeWindow.info['containergeom']
+        axis, steps = self.cursorsteps[keycode]
+        steps *= count
 
-        if ( keycode == 111 and ( self.activeWindow.info['containergeom'].y - 10 ) > self.screen.monitor[self.currentMonitor].workarea.screenY ): #cursor up
-            newy = self.get_gridmoveY('up')
-            height = self.get_gridresize_height('up', 'TL')
-
-        if ( keycode == 116 and ( self.activeWindow.info['containergeom'].height + 10 ) // self.screen.monitor[self.currentMonitor].lattice.slotHeight > 1): #cursor down
-            newy = self.get_gridmoveY('down')
-            height = self.get_gridresize_height('down', 'TL')
-
-        if ( keycode == 113 and ( self.activeWindow.info['containergeom'].x - 10 ) > self.screen.monitor[self.currentMonitor].workarea.screenX ): #cursor left
-            newx = self.get_gridmoveX('left')
-            width = self.get_gridresize_width('left', 'TL')
-
-        if ( keycode == 114 and ( self.activeWindow.info['containergeom'].width + 10 ) // self.screen.monitor[self.currentMonitor].lattice.slotWidth > 1 ): #cursor right
-            newx = self.get_gridmoveX('right')
-            width = self.get_gridresize_width('right', 'TL')
+        if ( axis == 'x' ):
+            newx = self.get_lattice().resize_start( 'x', geom.x, geom.x + geom.width, steps )
+            width = geom.x + geom.width - newx
+        else:
+            newy = self.get_lattice().resize_start( 'y', geom.y, geom.y + geom.height, steps )
+            height = geom.y + geom.height - newy
 
         self.configureWin(newx, newy, width, height)
 
@@ -344,112 +632,90 @@ class Xlettuce:
         if ( not self.is_ongrid(X, Y) ) : # make sure tilekey grid coordinates are within valid range
             return False
         
-        if self.firstX == -1 or self.firstY == -1 :
-            # this is the first tiling button press, set top left coordinates
+        if self.firstX == -1 or self.firstY == -1 or self.firstScreen is not self.screen :
+            # this is the first tiling button press, set top left coordinates - a first key pressed on another screen doesn't count
             self.firstX = X
             self.firstY = Y
+            self.firstScreen = self.screen
         else:
-            secondX = X
-            secondY = Y
-            width = secondX - self.firstX
-            height = secondY - self.firstY
-            
-            if ( width < 0 or height < 0 ):
-                #switch first and second
-                tempx = self.firstX
-                tempy = self.firstY
-                self.firstX = secondX
-                self.firstY = secondY
-                secondX = tempx
-                secondY = tempy
-            
-            # translate grid coordinates into screen coordinates
-            self.firstX = self.get_grid_screenX( self.firstX )
-            self.firstY = self.get_grid_screenY( self.firstY )
-            secondX = self.get_grid_screenX( secondX + 1 ) - 1
-            secondY = self.get_grid_screenY( secondY + 1 ) - 1
-            width = secondX - self.firstX
-            height = secondY - self.firstY
-
-
-            # make sure move location is within range
-            if self.is_onscreen(self.firstX, self.firstY) and self.is_onscreen(secondX, secondY) and ( width > 0 ) and ( height > 0 ) :
-                self.configureWin( self.firstX, self.firstY, width, height )
+            # the two keys can be pressed in any order - take the cells between them
+            x, y, width, height = self.get_lattice().cell_rect( min( self.firstX, X ), min( self.firstY, Y ), max( self.firstX, X ), max( self.firstY, Y ) )
+            self.configureWin( x, y, width, height )
 
             # reset moveto X Y values
             self.firstX = -1
             self.firstY = -1
 
     def configureWin( self, x, y, width, height ):
-        '''Move and resize window.'''
+        '''Move and resize window.
+        x, y, width, height describe the container (frame) - -1 means don't change.  The request is sent once, with the
+        correction learned for this window's class already applied, and checked asynchronously when the frame settles.'''
 
         #set position and dimensions = -1 means don't change
+        geom = self.activeWindow.info['containergeom']
         if x == -1 :
-            x = self.activeWindow.info['containergeom'].x
+            x = geom.x
         if y == -1 :
-            y = self.activeWindow.info['containergeom'].y
+            y = geom.y
         if width == -1 :
-            width = self.activeWindow.info['containergeom'].width
+            width = geom.width
         if height == -1 :
-            height = self.activeWindow.info['containergeom'].height
-
-        targetX=x
-        targetY=y
-        targetWidth=width
-        targetHeight=height
-
-        #correct for window container padding
-        x = ( x + self.activeWindow.info['padleft'] )
-        y = ( y + self.activeWindow.info['padtop'] )
-        width = ( width - self.activeWindow.info['padleft'] - self.activeWindow.info['padright'] )
-        height = ( height - self.activeWindow.info['padtop'] - self.activeWindow.info['padbottom'] )
-
-
-        #reposition window
-        logging.debug("POSITION window.configure(x=%d,  y=%d,  width=%d,  height=%d)" % (x, y, width, height))
-        self.activeWindow.configure(x=x,  y=y,  width=width,  height=height)
-
-        self.activeWindow.info=self.screen.get_xwininfo(self.activeWindow)
-
-        #test position - some windows (GTK I think) reposition themselves when reparented toadd title bar, so they're off on Y axis by the titlebar height
-        contX=self.activeWindow.info['containergeom'].x
-        contY=self.activeWindow.info['containergeom'].y
-        contWidth=self.activeWindow.info['containergeom'].width
-        contHeight=self.activeWindow.info['containergeom'].height
-
-        logging.debug("x %s - y %s - width %s - height %s" % (x,  y,  width,  height ))
-        logging.debug("contx %s - conty %s - contwidth %s - contheight %s" % (contX,  contY,  contWidth,  contHeight ))
-        logging.debug("targetx %s - targety %s - targetwidth %s - targetheight %s" % (targetX, targetY,  targetWidth, targetHeight ))
-
-        #for k in self.activeWindow.info['WM_NORMAL_HINTS']:
-            #print("wnh: %s -- %s" % (bin(k), k))
-
-        change = False
-        if ( contX != targetX ):
-            x = x + ( targetX - contX )
-            change = True
-        if ( contY != targetY ):
-            y = y + ( targetY - contY )
-            change = True
-        if ( contHeight != targetHeight ):
-            height = height + ( targetHeight - contHeight )
-            change = True
-        if ( contWidth != targetWidth ):
-            width = width + ( targetWidth - contWidth )
-            change = True
-
-        if (x<0 or y<0 or width<0 or height<0):
-            # one of the values is negative - one way this happens is when we try to resize a window smaller than its minimum size
+            height = geom.height
+
+        # uncorrected request - frame position, client size (the container minus its padding)
+        target = ( x, y, width, height )
+        base = ( x, y,
+                 width - self.activeWindow.info['padleft'] - self.activeWindow.info['padright'],
+                 height - self.activeWindow.info['padtop'] - self.activeWindow.info['padbottom'] )
+
+        method, offset = self.get_placement( self.activeWindow.info['WM_CLASS'] )
+        x, y, width, height = [ b + o for b, o in zip( base, offset ) ]
+        logging.debug("POSITION %s (x=%d,  y=%d,  width=%d,  height=%d) target %s" % (method, x, y, width, height, target))
+        if ( not self.screen.place( self.activeWindow, method, x, y, width, height ) ):
             return False
 
-        if change == True:
-            #reposition window
-            logging.debug("TEST REPOSITION window.configure(x=%d,  y=%d,  width=%d,  height=%d)" % (x, y, width, height))
-            self.activeWindow.configure(x=x,  y=y,  width=width,  height=height)
+        self.placement.expect( self.screen, self.activeWindow, method, target, base )
+
+        # assume the move landed, so a following keypress works from the new geometry - ConfigureNotify corrects it if not
+        geom.x, geom.y, geom.width, geom.height = target
 
         self.display.flush()
 
 
+    def get_placement( self, wmclass, screen=None ):
+        '''( method, offset ) to place a window of this class with.  The fast path is a single _NET_MOVERESIZE_WINDOW request -
+        classes that ignore it, and WMs without it, get a configure.  offset is the learned correction for the class.
+        screen is the screen the window is on - the current one if None.'''
+        screen = screen or self.screen
+        record = self.placement.get( wmclass, screen.wm_name )
+        if ( record is None ):
+            return ( "ewmh" if screen.supports_moveresize else "configure", ( 0, 0, 0, 0 ) )
+        return ( record.method, record.offset )
+
+
+    def place_clients( self, placements, screen=None ):
+        '''
+        Move a batch of windows in one burst - every request is queued, then sent with a single flush.
+        placements is a list of ( client, desktop, ( x, y, width, height ) ) - client is a Bunch from Screen.probe_clients,
+        desktop is None to leave the window on its current desktop, and the rectangle is the target for the window's frame.
+        The windows are all on screen - the current one if None.
+        '''
+        screen = screen or self.screen
+        for client, desktop, ( x, y, width, height ) in placements:
+            left, right, top, bottom = client.extents
+            client.window.info = { 'padleft': left, 'padtop': top, 'WM_CLASS': client.wmclass }
+
+            if ( desktop is not None and desktop != client.desktop ):
+                screen.send_event( client.window, screen.atom._NET_WM_DESKTOP, [ desktop, 2 ], flush=False )
+
+            method, offset = self.get_placement( client.wmclass, screen )
+            base = ( x, y, width - left - right, height - top - bottom )
+            x, y, width, height = [ b + o for b, o in zip( base, offset ) ]
+            screen.place( client.window, method, x, y, width, height, flush=False )
+
+        screen.display.flush()
+
+
     def desktopkey(self,  keycode):
         '''Desktop hotkeys - 3x3 grid.  HOLD capslock + numpad key moves to different desktop.'''
 
@@ -458,21 +724,41 @@ class Xlettuce:
         if ( self.e.modonly("alt") ) and ( self.valid_window() ):
             # send window to different desktop, then change view to that desktop as well
             logging.debug("desktop - alt - sendwin, follow")
-            self.screen.send_event( window, self.display.intern_atom("_NET_WM_DESKTOP"), [self.desktopkeymap[keycode]] )
-            self.screen.send_event( self.root, self.display.intern_atom("_NET_CURRENT_DESKTOP"), [self.desktopkeymap[keycode]] )
+            self.screen.send_event( window, self.screen.atom._NET_WM_DESKTOP, [self.desktopkeymap[keycode]] )
+            self.screen.send_event( self.root, self.screen.atom._NET_CURRENT_DESKTOP, [self.desktopkeymap[keycode]] )
 
         elif ( self.e.modonly("control") ) and ( window != self.root ) and ( self.activeWindow.info['WM_NAME'].lower() !=  "desktop" ):
             logging.debug("desktop - ctrl - sendwin, don'tfollow")
             # send window to different desktop, keep view on current desktop
-            self.screen.send_event( window, self.display.intern_atom("_NET_WM_DESKTOP"), [self.desktopkeymap[keycode]] )
+            self.screen.send_event( window, self.screen.atom._NET_WM_DESKTOP, [self.desktopkeymap[keycode]] )
 
         elif ( self.modnone ):
             logging.debug("desktop - modnone - don't sendwin, go to desktop")
             # switch to desktop ##
-            self.screen.send_event( self.root, self.display.intern_atom("_NET_CURRENT_DESKTOP"), [self.desktopkeymap[keycode]] )
+            self.screen.send_event( self.root, self.screen.atom._NET_CURRENT_DESKTOP, [self.desktopkeymap[keycode]] )
+
 
 
 
+def is_xlettuce( pid ):
+    '''
+    True if pid is a running Xlettuce - one of its arguments is the xlettuce.py script (so xlettuce-ctl, or an editor with
+    xlettuce.conf open, don't count).  Reads /proc where there is one - psutil is only imported where there isn't.
+    '''
+    if ( os.path.isdir( "/proc/self" ) ):
+        try:
+            with open( "/proc/%d/cmdline" % pid, 'rb' ) as f:
+                argv = f.read().decode( 'utf-8', 'replace' ).split( "\0" )
+        except EnvironmentError:
+            return False
+    else:
+        import psutil
+        try:
+            argv = psutil.Process( pid ).cmdline()
+        except psutil.Error:
+            return False
+    return any( os.path.basename( arg ).lower() == "xlettuce.py" for arg in argv )
+
 
 if __name__ == "__main__":
     # running as tiling script
@@ -486,11 +772,9 @@ if __name__ == "__main__":
             oldpid = int(f.read())
         print("OLD: %i" % oldpid)
         
-        if ( psutil.pid_exists(oldpid) ):
-            p=psutil.Process(oldpid)
-            if ( "xlettuce" in p.name().lower() ):
-                print ( "Xlettuce is already running: %s " % p.name() )
-                exit()
+        if ( is_xlettuce( oldpid ) ):
+            print ( "Xlettuce is already running: %i " % oldpid )
+            exit()
     
     # write PID to file
     pid=str(os.getpid())
@@ -499,7 +783,7 @@ if __name__ == "__main__":
     pidfile.close()
     
     # run tiler
-    xlettuce = Xlettuce()
+    xlettuce = Xlettuce( startup_trace = "--startup-trace" in sys.argv[1:] )
     
     os.remove(pidfilename)
 
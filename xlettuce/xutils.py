@@ -2,7 +2,9 @@
 
 # xprobe - miscellaneous classes for gathering information about the user's X environment
 
-import subprocess, Xlib, Xlib.display, re, weakref
+import Xlib, Xlib.display, Xlib.error, Xlib.Xatom, Xlib.protocol.request, weakref, os
+from Xlib.ext import randr
+import xl_lattice, xl_registry, xl_xcount
 import logging
 logger = logging.getLogger(__name__)
 
@@ -13,20 +15,158 @@ class Bunch( dict ):
         self.__dict__ = self
 
 
+def geom_bunch( geom ):
+    '''copy a get_geometry() reply into a mutable Bunch, so cached geometry can be updated from ConfigureNotify events'''
+    return Bunch( x=geom.x, y=geom.y, width=geom.width, height=geom.height, border_width=geom.border_width )
+
+
+def class_name( wmclass ):
+    '''WM_CLASS property value ( "instance\\0class\\0" ) -> "instance.class" string, usable as a dict key or in a file'''
+    if ( not wmclass ):
+        return ""
+    if ( isinstance( wmclass, bytes ) ):
+        wmclass = wmclass.decode( 'latin-1' )
+    return str( wmclass ).strip( "\0" ).replace( "\0", "." )
+
+
 class Screen:
     '''
     Gathers information about the user's X screen/monitor geometry.
     '''
+
+    # EWMH/ICCCM atoms used by Xlettuce - interned in one batch at startup, available as self.atom.<NAME>
+    atomnames = ( '_NET_ACTIVE_WINDOW', '_NET_CLIENT_LIST', '_NET_CURRENT_DESKTOP', '_NET_FRAME_EXTENTS', '_NET_MOVERESIZE_WINDOW',
+                  '_NET_NUMBER_OF_DESKTOPS', '_NET_SUPPORTED', '_NET_SUPPORTING_WM_CHECK', '_NET_WM_DESKTOP', '_NET_WM_NAME', '_NET_WM_PID', '_NET_WM_STATE',
+                  '_NET_WM_STATE_ABOVE', '_NET_WM_STATE_HIDDEN', '_NET_WM_WINDOW_TYPE',
+                  '_NET_WM_WINDOW_TYPE_DESKTOP', '_NET_WM_WINDOW_TYPE_DOCK', '_NET_WORKAREA', 'WM_CHANGE_STATE' )
+
+    # _NET_MOVERESIZE_WINDOW flags - NorthWest gravity (x/y give the frame's top left corner), x/y/width/height all set,
+    # source indication 2 (pager/tool, so the WM doesn't second guess the request)
+    moveresizeflags = Xlib.X.NorthWestGravity | ( 0xF << 8 ) | ( 2 << 12 )
+
+    # predefined atoms - these have fixed values, no need to intern them
+    predefinedatoms = { 'WM_NAME': Xlib.Xatom.WM_NAME, 'WM_CLASS': Xlib.Xatom.WM_CLASS,
+                        'WM_NORMAL_HINTS': Xlib.Xatom.WM_NORMAL_HINTS, 'WM_HINTS': Xlib.Xatom.WM_HINTS }
     
-    def __init__( self, parent ):
+    def __init__( self, parent, name=None, index=0 ):
+        '''name is the X display to connect to - eg: ":0.1" - or None for $DISPLAY.  Its screen is the one managed here.
+        index is this Screen's position in the parent's list of screens.'''
         #initialize xlib objects
         self.parent = weakref.proxy(parent)
-        self.display = Xlib.display.Display()
+        trace = parent.trace
+        self.display = Xlib.display.Display( name )
         self.root = self.display.screen().root
-        
+        self.name = self.display.get_display_name()
+        self.index = index
+        trace.mark("x connect")
+
+        # optional request/round trip accounting - wraps the connection before anything is sent, so startup is counted too
+        self.xcount = None
+        self.set_xcount( parent.snap.general.count_requests, parent.snap.general.round_trip_budget )
+
+        # intern every atom Xlettuce uses up front - nothing on a hot path should need an InternAtom round trip
+        self.atom = self.intern_atoms( self.atomnames )
+        trace.mark("atoms")
+
+        # active window cache - kept current from PropertyNotify/ConfigureNotify events instead of probed on every keystroke
+        self.activeWindow = None
+        self.activeWindowValid = False
+
+        # frame extents cache - window id -> Bunch(padleft, padtop, padright, padbottom, container)
+        self.frames = {}
+
+        # check whether windows can be placed with _NET_MOVERESIZE_WINDOW
+        self.probe_wm()
+        trace.mark("wm probe")
+
+        self.currentMonitor = 0
+
+        # listen for property changes on the root window (_NET_ACTIVE_WINDOW, etc)
+        self.root_event_mask = Xlib.X.PropertyChangeMask
+        self.root.change_attributes( event_mask = self.root_event_mask )
+
+        self.registry = None # created once the monitors are known - the registry indexes windows by monitor and grid cell
+
+        self.init_randr()
         self.refresh() # get screen geometry info
+        trace.mark("monitors")
+
+        # every managed window, kept current from events on the root
+        self.registry = xl_registry.WindowRegistry( self )
+        trace.mark("window registry")
 
         
+    def environ( self ):
+        '''a copy of the environment with DISPLAY pointing at this screen - for the commands launched on it'''
+        env = dict( os.environ )
+        env['DISPLAY'] = self.name
+        return env
+
+
+    def set_xcount( self, enabled, budget=0 ):
+        '''turn X request accounting on or off'''
+        if ( enabled and self.xcount is None ):
+            self.xcount = xl_xcount.XCounter( self.display, budget )
+        elif ( not enabled and self.xcount is not None ):
+            self.xcount.uninstall()
+            self.xcount = None
+        if ( self.xcount ):
+            self.xcount.budget = budget
+
+
+    def intern_atoms( self, names ):
+        '''Intern a batch of atoms with a single round trip - every InternAtom request is sent before waiting on any reply.
+        Returns a Bunch of atom name -> atom, including the predefined atoms.'''
+        requests = [ Xlib.protocol.request.InternAtom( display = self.display.display, defer = True, name = name, only_if_exists = 0 ) for name in names ]
+        atoms = Bunch( **self.predefinedatoms )
+        for name, req in zip( names, requests ):
+            atoms[name] = req.reply().atom
+        return atoms
+
+
+    def probe_wm( self ):
+        '''check which EWMH features the window manager supports.  Called on init, and when the WM changes _NET_SUPPORTED.'''
+        try:
+            supported = self.root.get_full_property( self.atom._NET_SUPPORTED, Xlib.Xatom.ATOM ).value
+        except ( AttributeError, TypeError ):
+            supported = []
+        self.supports_moveresize = self.atom._NET_MOVERESIZE_WINDOW in supported
+
+        # the WM's name, from the _NET_WM_NAME of its _NET_SUPPORTING_WM_CHECK window - placement corrections are per WM
+        try:
+            check = self.root.get_full_property( self.atom._NET_SUPPORTING_WM_CHECK, Xlib.Xatom.WINDOW ).value[0]
+            wmwindow = self.display.create_resource_object( 'window', check )
+            name = wmwindow.get_full_property( self.atom._NET_WM_NAME, Xlib.X.AnyPropertyType ).value
+            self.wm_name = ( name.decode( 'utf-8', 'replace' ) if isinstance( name, bytes ) else str( name ) ) or "unknown"
+        except ( AttributeError, TypeError, IndexError, Xlib.error.XError ):
+            self.wm_name = "unknown"
+
+        logger.info("window manager %s %s _NET_MOVERESIZE_WINDOW" % ( self.wm_name, "supports" if self.supports_moveresize else "does not support" ))
+
+
+    def moveresize( self, window, x, y, width, height, flush=True ):
+        '''Ask the WM to move the window's frame to x, y and resize the client to width x height, in a single request.'''
+        self.send_event( window, self.atom._NET_MOVERESIZE_WINDOW, [ self.moveresizeflags, x, y, width, height ], flush=flush )
+
+
+    def place( self, window, method, x, y, width, height, flush=False ):
+        '''
+        Send a placement request for a window: frame at x, y with a width x height client area.
+        method "ewmh" uses _NET_MOVERESIZE_WINDOW, "configure" configures the client window directly (offset by its frame extents).
+        '''
+        if ( width <= 0 or height <= 0 ):
+            # one way this happens is when we try to resize a window smaller than its minimum size
+            return False
+
+        if ( method == "ewmh" and self.supports_moveresize ):
+            self.moveresize( window, x, y, width, height, flush=flush )
+        else:
+            window.configure( x=x + window.info['padleft'], y=y + window.info['padtop'], width=width, height=height, onerror=Xlib.error.CatchError() )
+            if flush:
+                self.display.flush()
+        return True
+
+
     def refresh( self ):
         '''Check screen geometry
         Call on init, and whenever screen changes or changes to the config file are detected.
@@ -37,6 +177,18 @@ class Screen:
         # retrieve info about connected monitors
         self.probe_monitors()
 
+
+    def init_randr( self ):
+        '''check for the RandR extension, and subscribe to screen/crtc/output change notifications so monitor hotplugs are picked up live'''
+        self.has_randr = self.display.has_extension( randr.extname )
+        if ( not self.has_randr ):
+            logger.warning("RandR extension not available - treating the whole screen as a single monitor")
+            return
+
+        # the server only sends RandR 1.2+ events to clients that have announced their version
+        self.display.xrandr_query_version()
+        self.root.xrandr_select_input( randr.RRScreenChangeNotifyMask | randr.RRCrtcChangeNotifyMask | randr.RROutputChangeNotifyMask )
+
     
     def probe_screen( self ):
         """
@@ -44,21 +196,19 @@ class Screen:
         Called on init, should also be called on screen geometry change.
         """
         
-        # pull full screen size and per-monitor info from xrandr
-        self.xrandr=subprocess.check_output("xrandr", universal_newlines=True)
+        # full screen size is the size of the root window
+        rootgeom = self.root.get_geometry()
+        self.width = rootgeom.width
+        self.height = rootgeom.height
 
-        #initialize monitor Bunch - stores screen geometry and geometry for all monitors
-        self.monitor = Bunch()
-        self.monitor.count=0
-        
-        #get screen info from xrandr
-        match=re.search("^Screen 0:[ \w,]*current ([0-9]*) x ([0-9]*)", self.xrandr, flags=re.MULTILINE)
-        # ------match groups: (0:width) (1:height)
-        self.width = int(match.group(1))
-        self.height = int(match.group(2))
+        self.probe_workarea()
+
+
+    def probe_workarea( self ):
+        '''read _NET_WORKAREA and work out the panel clearances on each screen edge'''
 
         # get workarea size - this doesn't include the panels - # returns a list at workarea.value[] composed of ints [ x, y, width, height ] for each available virtual desktop
-        workarea = self.root.get_full_property(self.display.intern_atom('_NET_WORKAREA'), Xlib.X.AnyPropertyType) 
+        workarea = self.root.get_full_property(self.atom._NET_WORKAREA, Xlib.X.AnyPropertyType) 
         
         self.avail_width = int(workarea.value[2]) # tiling area width (px)
         self.avail_height = int(workarea.value[3]) # tiling area height (px)
@@ -72,46 +222,77 @@ class Screen:
         self.panel_bottom = self.height - ( self.avail_screenY + self.avail_height )
 
 
+    def probe_outputs( self ):
+        '''
+        Query RandR for the active outputs (monitors).  Returns a list of Bunch( name, crtc, width, height, screenX, screenY ),
+        with the primary output first.  Outputs that clone another output's CRTC are only listed once.
+        '''
+        if ( not self.has_randr ):
+            return [ Bunch( name="default", crtc=0, width=self.width, height=self.height, screenX=0, screenY=0 ) ]
+
+        # GetScreenResourcesCurrent doesn't make the server poll the hardware for changes, so it's quick
+        resources = self.root.xrandr_get_screen_resources_current()
+        primary = self.root.xrandr_get_output_primary().output
+
+        outputs = []
+        crtcs = set()
+        for output in resources.outputs:
+            info = self.display.xrandr_get_output_info( output, resources.config_timestamp )
+            if ( info.connection != randr.Connected or not info.crtc or info.crtc in crtcs ):
+                continue
+
+            crtc = self.display.xrandr_get_crtc_info( info.crtc, resources.config_timestamp )
+            if ( not crtc.mode ):
+                continue # connected but switched off
+            crtcs.add( info.crtc )
+
+            name = info.name.decode() if isinstance( info.name, bytes ) else str( info.name )
+            out = Bunch( name=name, crtc=info.crtc, width=crtc.width, height=crtc.height, screenX=crtc.x, screenY=crtc.y )
+            if ( output == primary ):
+                outputs.insert( 0, out )
+            else:
+                outputs.append( out )
+
+        return outputs
+
+
     def probe_monitors( self ):
         '''retrieve monitor information for up to four connected monitors.'''
-        
-        # check for PRIMARY monitor
-        match=re.search("^([-A-Z0-9]*) connected primary ([0-9]*)x([0-9]*)\+([0-9]*)\+([0-9]*)", self.xrandr, flags=re.MULTILINE)
-        # ------match groups: (0:device_name) (1:width) (2:height) (3:xpos) (4:ypos)
-        if ( match ):
-            # there is a primary monitor.  Initialize [0] and get its info
-            self.monitor[0] = self.probe_monitor_geometry( 0, match )
-            
-            # make alias for primary
-            self.monitor[ 'primary' ] = self.monitor[ 0 ]
-            self.monitor['count'] += 1 # monitor counter
 
-        # gather info on all other connected monitors
-        for match in re.finditer( "^([-A-Z0-9]*) connected ([0-9]*)x([0-9]*)\+([0-9]*)\+([0-9]*)", self.xrandr, flags=re.MULTILINE ):
-            # ------match groups: (0:device_name) (1:width) (2:height) (3:xpos) (4:ypos)
-            
-            self.monitor[self.monitor['count']] = self.probe_monitor_geometry( self.monitor['count'], match )
+        #initialize monitor Bunch - stores geometry for all monitors
+        self.monitor = Bunch()
+        self.monitor.count=0
+
+        for output in self.probe_outputs():
+            self.monitor[self.monitor['count']] = self.probe_monitor_geometry( self.monitor['count'], output )
             self.monitor['count'] += 1 # increment monitor count
             
             if ( self.monitor['count'] >= 4 ) :
                 break # only supports 4 monitors for now - artificial limitation though, because conf file only specifies 4 monitor grids, 4 activation buttons, etc.  TODO: fix this limitation - practically speaking it's probably fine, but may as well fix.
 
+        if ( self.monitor['count'] > 0 ):
+            # make alias for primary
+            self.monitor[ 'primary' ] = self.monitor[ 0 ]
+
+        if ( self.registry ):
+            self.registry.reindex()
 
-    def probe_monitor_geometry( self, monitornum, regex_match ):
+
+    def probe_monitor_geometry( self, monitornum, output ):
         '''
-        Parse a regex match to pull monitor geometry information
-        eg: HDMI-0 connected primary 3840x2160+0+0
-        ------match groups: (0:device_name) (1:width) (2:height) (3:xpos) (4:ypos)
+        Calculate the work area and tiling lattice for a monitor.
+        output is a Bunch( name, crtc, width, height, screenX, screenY ), as returned by probe_outputs
         '''
         mon=Bunch()
         mon.workarea=Bunch()
-        mon.lattice=Bunch()
         
-        mon.name = str( regex_match.group(1) )
-        mon.width = int( regex_match.group(2) ) # monitor width in Pixels
-        mon.height = int( regex_match.group(3) ) # monitor height in Pixels
-        mon.screenX = int( regex_match.group(4) ) # X Offset of monitor relative to whole screen
-        mon.screenY = int( regex_match.group(5) ) # Y Offset of monitor relative to whole screen
+        mon.output = output
+        mon.name = output.name
+        mon.crtc = output.crtc
+        mon.width = output.width # monitor width in Pixels
+        mon.height = output.height # monitor height in Pixels
+        mon.screenX = output.screenX # X Offset of monitor relative to whole screen
+        mon.screenY = output.screenY # Y Offset of monitor relative to whole screen
         
         # calculate active workarea - ie: the tiling area - space accessible to windows, excludes inaccessible areas covered by panels, etc.
         # this assumes no panels in the middle of multimonitor setups
@@ -124,28 +305,81 @@ class Screen:
         mon.workarea.height = ( mon.height - mon.workarea.monY ) - max ( 0, ( mon.screenY + mon.height - (self.avail_screenY + self.avail_height ) ) )
         
         # create tiling grid
-        mon.lattice.gridX = int( self.parent.conf.get("MONITORS", "Mon"+str( monitornum )+'_Grid_X' ) ) # number of grid hotkeys - pulls from conf
-        mon.lattice.gridY = int( self.parent.conf.get("MONITORS", "Mon"+str( monitornum )+'_Grid_Y' ) ) # number of grid hotkeys - pulls from conf
-        mon.lattice.slotsX = mon.lattice.gridX # number of lattice slots - one less than the number of grid keys
-        mon.lattice.slotsY = mon.lattice.gridY # number of lattice slots - one less than the number of grid keys
-        mon.lattice.slotWidth = mon.workarea.width // mon.lattice.gridX
-        mon.lattice.slotHeight = mon.workarea.height // mon.lattice.gridY
+        settings = self.parent.snap.monitors[monitornum]
+        mon.lattice = xl_lattice.Lattice( mon.workarea.screenX, mon.workarea.screenY, mon.workarea.width, mon.workarea.height,
+                                          settings.grid_x, settings.grid_y, settings.weights_x, settings.weights_y )
         
         return mon
 
 
+    def rebuild_monitor( self, monitornum ):
+        '''recalculate the work area and lattice of a single monitor from its stored output geometry'''
+        self.monitor[monitornum] = self.probe_monitor_geometry( monitornum, self.monitor[monitornum].output )
+        if ( monitornum == 0 ):
+            self.monitor[ 'primary' ] = self.monitor[ 0 ]
+        if ( self.registry ):
+            self.registry.reindex()
+
+
+    def rebuild_monitors( self ):
+        '''recalculate every monitor's work area and lattice, keeping the known monitor layout'''
+        for i in range( self.monitor['count'] ):
+            self.rebuild_monitor( i )
+
+
+    def crtc_changed( self, event ):
+        '''RRCrtcChangeNotify - rebuild only the monitor driven by this CRTC.
+        If a CRTC was switched on or off, the set of monitors has changed, so rescan them all.'''
+        for i in range( self.monitor['count'] ):
+            if ( self.monitor[i].crtc == event.crtc ):
+                break
+        else:
+            if ( event.mode ):
+                logger.info("RandR: CRTC %s enabled - rescanning monitors" % event.crtc )
+                self.probe_monitors()
+            return
+
+        if ( not event.mode ):
+            logger.info("RandR: CRTC %s disabled - rescanning monitors" % event.crtc )
+            self.probe_monitors()
+            return
+
+        # the event reports the unrotated mode size, so ask for the CRTC's real geometry
+        crtc = self.display.xrandr_get_crtc_info( event.crtc, Xlib.X.CurrentTime )
+        output = self.monitor[i].output
+        if ( ( crtc.x, crtc.y, crtc.width, crtc.height ) == ( output.screenX, output.screenY, output.width, output.height ) ):
+            return
+
+        logger.info("RandR: monitor %d (%s) is now %dx%d+%d+%d" % ( i, output.name, crtc.width, crtc.height, crtc.x, crtc.y ) )
+        output.screenX = crtc.x
+        output.screenY = crtc.y
+        output.width = crtc.width
+        output.height = crtc.height
+        self.rebuild_monitor( i )
+
+
+    def screen_changed( self, event ):
+        '''RRScreenChangeNotify - the size of the root window changed.  Panel clearances are recalculated, monitors keep their layout.'''
+        self.probe_screen()
+        self.rebuild_monitors()
+
+
     def set_grab_trigger( self, keycode = 66 ):
         '''Sets up the root object to capture presses and releases of a specific trigger key.
-        Generates all possible mod key combinations for the trigger key.
+        One AnyModifier grab covers every modifier combination (capslock, numlock, etc included) in a single request.
         Keycode should be the value labeled "Keycode" in the output of the xev bash command.
         Defaults to 66 -> CAPS_LOCK 
         Trigger key will activate XLettuce when pressed, and deactivate it when released.
         '''
-        self.root.change_attributes( event_mask = Xlib.X.KeyPressMask | Xlib.X.KeyReleaseMask )
-        for v in range(256):
-            # generate and grab all possible mod key combinations for capslock key.
-            self.root.grab_key(66, v, 1, Xlib.X.GrabModeAsync, Xlib.X.GrabModeAsync)
+        self.root_event_mask |= Xlib.X.KeyPressMask | Xlib.X.KeyReleaseMask
+        self.root.change_attributes( event_mask = self.root_event_mask )
+        self.root.grab_key(keycode, Xlib.X.AnyModifier, 1, Xlib.X.GrabModeAsync, Xlib.X.GrabModeAsync)
                 
+    def ungrab_trigger( self, keycode ):
+        '''release the trigger key grabs set by set_grab_trigger'''
+        self.root.ungrab_key(keycode, Xlib.X.AnyModifier)
+
+
     def grab_keyboard( self ):
         self.root.grab_keyboard(1, Xlib.X.GrabModeAsync, Xlib.X.GrabModeAsync,  Xlib.X.CurrentTime)
 
@@ -156,18 +390,99 @@ class Screen:
 
     def set_num_desktops( self, num=9 ):
         '''set the number of virtual desktops.  Defaults to recommended 9 for good 3x3 grid navigation.'''
-        self.send_event( self.root, self.display.intern_atom("_NET_NUMBER_OF_DESKTOPS"), [num] )
+        self.send_event( self.root, self.atom._NET_NUMBER_OF_DESKTOPS, [num], flush=False )
 
 
     def get_active_window( self ):
-        '''Finds the active window, probes for window information, and returns a window object
+        '''Returns the active window object, with window information attached as window.info.
+        The result is cached, and only probed again once a _NET_ACTIVE_WINDOW change (or the window's destruction) invalidates it.
         '''
-        activewindowID = self.root.get_full_property(self.display.intern_atom('_NET_ACTIVE_WINDOW'), Xlib.X.AnyPropertyType).value[0]
+        if ( self.activeWindowValid ):
+            return self.activeWindow
+
+        activewindowID = self.root.get_full_property(self.atom._NET_ACTIVE_WINDOW, Xlib.X.AnyPropertyType).value[0]
         self.activeWindow = self.display.create_resource_object('window', activewindowID)
         self.activeWindow.info=self.get_xwininfo(self.activeWindow)
+        self.watch_window(self.activeWindow)
+        self.activeWindowValid = True
         return self.activeWindow;
-    
-                
+
+
+    def invalidate_active_window( self ):
+        self.activeWindowValid = False
+
+
+    def watch_window( self, window ):
+        '''select the events needed to keep the cached info for a window current:
+        property changes and destruction on the client window, moves/resizes on its container (the WM frame).'''
+        if ( window == self.root ):
+            return
+        window.change_attributes( event_mask = Xlib.X.PropertyChangeMask | Xlib.X.StructureNotifyMask, onerror = Xlib.error.CatchError() )
+        container = window.info['container']
+        if ( container != window ):
+            container.change_attributes( event_mask = Xlib.X.StructureNotifyMask, onerror = Xlib.error.CatchError() )
+
+
+    def process_event( self, event ):
+        '''update cached window state from a non-keyboard X event'''
+        active = self.activeWindow
+
+        # monitor hotplug / reconfiguration
+        if ( self.has_randr ):
+            if ( isinstance( event, randr.ScreenChangeNotify ) ):
+                self.screen_changed( event )
+                return
+            elif ( isinstance( event, randr.CrtcChangeNotify ) ):
+                self.crtc_changed( event )
+                return
+            elif ( isinstance( event, randr.OutputChangeNotify ) ):
+                # a monitor was plugged in or unplugged
+                self.probe_monitors()
+                return
+
+        self.registry.process_event( event )
+
+        # the window manager was replaced
+        if ( event.type == Xlib.X.PropertyNotify and event.window == self.root and event.atom == self.atom._NET_SUPPORTED ):
+            self.probe_wm()
+            return
+
+        # panels were added, removed or resized
+        if ( event.type == Xlib.X.PropertyNotify and event.window == self.root and event.atom == self.atom._NET_WORKAREA ):
+            self.probe_workarea()
+            self.rebuild_monitors()
+            return
+
+        # frame extents change when a window is reparented, destroyed, or the WM updates _NET_FRAME_EXTENTS
+        if ( event.type in ( Xlib.X.DestroyNotify, Xlib.X.ReparentNotify ) ):
+            self.forget_frame( event.window )
+        elif ( event.type == Xlib.X.PropertyNotify and event.atom == self.atom._NET_FRAME_EXTENTS ):
+            self.forget_frame( event.window )
+
+        if ( event.type == Xlib.X.PropertyNotify ):
+            if ( event.window == self.root and event.atom == self.atom._NET_ACTIVE_WINDOW ):
+                self.invalidate_active_window()
+            elif ( active is not None and event.window == active ):
+                # title/class/hints of the active window changed
+                self.invalidate_active_window()
+
+        elif ( active is None or not self.activeWindowValid ):
+            return
+
+        elif ( event.type == Xlib.X.ConfigureNotify ):
+            if ( event.window == active.info['container'] ):
+                # the active window's frame moved or was resized - update cached geometry in place
+                geom = active.info['containergeom']
+                geom.x = event.x
+                geom.y = event.y
+                geom.width = event.width
+                geom.height = event.height
+
+        elif ( event.type in ( Xlib.X.DestroyNotify, Xlib.X.ReparentNotify, Xlib.X.UnmapNotify ) ):
+            if ( event.window == active or event.window == active.info['container'] ):
+                self.invalidate_active_window()
+
+
     def get_xwininfo( self,  window ):
         geom = window.get_geometry()
         info={
@@ -187,62 +502,201 @@ class Screen:
         'containergeom': 0 }
 
         try:
-            info["WM_NAME"]=window.get_full_property(39, Xlib.X.AnyPropertyType).value
+            info["WM_NAME"]=window.get_full_property(self.atom.WM_NAME, Xlib.X.AnyPropertyType).value
         except ( AttributeError, TypeError ):
             info["WM_NAME"]=False
         try:
-            info["WM_CLASS"]=window.get_full_property(67, Xlib.X.AnyPropertyType).value
+            info["WM_CLASS"]=window.get_full_property(self.atom.WM_CLASS, Xlib.X.AnyPropertyType).value
         except ( AttributeError, TypeError ):
             info["WM_CLASS"]=False
         try:
-            info["WM_NORMAL_HINTS"]=window.get_full_property(40, Xlib.X.AnyPropertyType).value
+            info["WM_NORMAL_HINTS"]=window.get_full_property(self.atom.WM_NORMAL_HINTS, Xlib.X.AnyPropertyType).value
         except ( AttributeError, TypeError ):
             info["WM_NORMAL_HINTS"]=False
         try:
-            info["WM_HINTS"]=window.get_full_property(35, Xlib.X.AnyPropertyType).value
+            info["WM_HINTS"]=window.get_full_property(self.atom.WM_HINTS, Xlib.X.AnyPropertyType).value
         except ( AttributeError, TypeError ):
             info["WM_HINTS"]=False
 
         info['fullheight']=geom.height+(2*geom.border_width) # height of active window including border
         info['fullwidth']=geom.width+(2*geom.border_width) # width of active window including border
         info['border']=geom.border_width # width of the active window border
-        info['padleft']=geom.x # offset from the container window
-        info['padtop']=geom.y # offset from the container window
-        info['container']=window
-        info['containergeom']=geom
-
-        curwin=window.query_tree().parent
-
-        while ( curwin !=  self.root):
-            geom=curwin.get_geometry()
-            info['padright'] += ( geom.width - ( info['fullwidth'] + info['padleft'] ) )
-            info['padbottom'] += ( geom.height - ( info['fullheight'] + info['padtop'] ) )
-            if (curwin.query_tree().parent != self.root):
-                info['padleft']+=geom.x
-                info['padtop']+=geom.y
-            info['container']=curwin
-            info['containergeom']=geom
-            curwin=curwin.query_tree().parent
+
+        frame = self.frames.get( window.id )
+        if ( frame is None ):
+            frame = self.probe_frame( window, geom )
+            self.frames[ window.id ] = frame
+            containergeom = frame.pop( 'probedgeom' ) # the tree walk already fetched the container geometry
+        elif ( frame.container == window ):
+            containergeom = geom
+        else:
+            containergeom = frame.container.get_geometry()
+
+        info['padleft']=frame.padleft # offset from the container window
+        info['padtop']=frame.padtop
+        info['padright']=frame.padright
+        info['padbottom']=frame.padbottom
+        info['container']=frame.container
+        info['containergeom']=geom_bunch(containergeom)
 
         return info
 
 
+    def probe_frame( self, window, geom ):
+        '''Work out the decoration offsets (frame extents) and the container window (the top level WM frame) for a window.
+        Uses _NET_FRAME_EXTENTS if the window manager sets it, and walks up the window tree to the root otherwise.
+        The result is cached in self.frames until the window is reparented, destroyed, or its _NET_FRAME_EXTENTS change.
+        '''
+        frame = Bunch( padleft=geom.x, padtop=geom.y, padright=0, padbottom=0, container=window, probedgeom=geom )
+        fullwidth = geom.width + ( 2 * geom.border_width )
+        fullheight = geom.height + ( 2 * geom.border_width )
+
+        # collect the chain of ancestors between the window and the root - one query_tree per level
+        ancestors = []
+        curwin = window.query_tree().parent
+        while ( curwin != self.root ):
+            ancestors.append( curwin )
+            curwin = curwin.query_tree().parent
+
+        try:
+            extents = window.get_full_property( self.atom._NET_FRAME_EXTENTS, Xlib.X.AnyPropertyType ).value
+        except ( AttributeError, TypeError ):
+            extents = None
+
+        if ( extents is not None and len( extents ) == 4 and ancestors ):
+            # _NET_FRAME_EXTENTS = left, right, top, bottom
+            frame.padleft, frame.padright, frame.padtop, frame.padbottom = [ int(v) for v in extents ]
+            frame.container = ancestors[-1]
+            frame.probedgeom = frame.container.get_geometry()
+            return frame
+
+        for i, curwin in enumerate( ancestors ):
+            geom = curwin.get_geometry()
+            frame.padright += ( geom.width - ( fullwidth + frame.padleft ) )
+            frame.padbottom += ( geom.height - ( fullheight + frame.padtop ) )
+            if ( i < len( ancestors ) - 1 ):
+                # not the top level frame yet
+                frame.padleft += geom.x
+                frame.padtop += geom.y
+            frame.container = curwin
+            frame.probedgeom = geom
+
+        return frame
+
+
+    def forget_frame( self, window ):
+        '''drop a window from the frame extents cache'''
+        self.frames.pop( window.id, None )
+
+
     def get_current_monitor( self , event ):
         #set current monitor
+        if ( self.currentMonitor >= self.monitor['count'] ):
+            self.currentMonitor = 0 # the monitor we were on has been unplugged
+        monitornum = self.monitor_at( event.root_x, event.root_y )
+        if ( monitornum is not None ):
+            self.currentMonitor = monitornum
+        
+        return self.currentMonitor
+
+
+    def monitor_at( self, x, y ):
+        '''index of the monitor containing screen coordinate x, y - or None if it's not on any monitor'''
         for i in range (0, self.monitor['count']):
             minX=self.monitor[i].screenX
             maxX=self.monitor[i].screenX+self.monitor[i].width
             minY=self.monitor[i].screenY
             maxY=self.monitor[i].screenY+self.monitor[i].height
 
-            if ( event.root_x >= minX and event.root_x <= maxX and event.root_y >= minY and event.root_y <= maxY):
-                self.currentMonitor=i
-                break
-        
-        return self.currentMonitor
+            if ( x >= minX and x <= maxX and y >= minY and y <= maxY):
+                return i
+
+        return None
+
+
+    def get_num_desktops( self ):
+        '''number of desktops, from _NET_NUMBER_OF_DESKTOPS - 9, what Xlettuce asks the WM for, if it isn't set'''
+        try:
+            return self.root.get_full_property( self.atom._NET_NUMBER_OF_DESKTOPS, Xlib.Xatom.CARDINAL ).value[0]
+        except ( AttributeError, TypeError, IndexError ):
+            return 9
 
 
-    def send_event( self, win, ctype, data, mask=None ):
+    def get_current_desktop( self ):
+        '''index of the desktop being shown, from _NET_CURRENT_DESKTOP'''
+        try:
+            return self.root.get_full_property( self.atom._NET_CURRENT_DESKTOP, Xlib.Xatom.CARDINAL ).value[0]
+        except ( AttributeError, TypeError, IndexError ):
+            return 0
+
+
+    def get_client_list( self ):
+        '''ids of the windows the WM manages, from _NET_CLIENT_LIST'''
+        try:
+            return list( self.root.get_full_property( self.atom._NET_CLIENT_LIST, Xlib.Xatom.WINDOW ).value )
+        except ( AttributeError, TypeError ):
+            return []
+
+
+    def probe_clients( self, windowids ):
+        '''
+        Fetch geometry and properties for a batch of client windows in a single round trip - every request is sent before
+        waiting on any reply.  Returns a list of Bunch( id, window, x, y, width, height, extents, desktop, wmclass, title, type, state, pid, hints ),
+        where x, y, width, height is the frame rectangle in screen coordinates.  Windows that have gone away are left out.
+        '''
+        d = self.display.display
+        props = ( self.atom.WM_CLASS, self.atom._NET_WM_NAME, self.atom.WM_NAME, self.atom._NET_WM_DESKTOP,
+                  self.atom._NET_FRAME_EXTENTS, self.atom._NET_WM_WINDOW_TYPE, self.atom._NET_WM_STATE, self.atom._NET_WM_PID,
+                  self.atom.WM_NORMAL_HINTS )
+
+        requests = []
+        for wid in windowids:
+            geom = Xlib.protocol.request.GetGeometry( display = d, defer = True, drawable = wid )
+            pos = Xlib.protocol.request.TranslateCoords( display = d, defer = True, src_wid = wid, dst_wid = self.root.id, src_x = 0, src_y = 0 )
+            values = [ Xlib.protocol.request.GetProperty( display = d, defer = True, delete = 0, window = wid, property = atom,
+                                                          type = Xlib.X.AnyPropertyType, long_offset = 0, long_length = 1024 ) for atom in props ]
+            requests.append( ( wid, geom, pos, values ) )
+
+        clients = []
+        for wid, geom, pos, values in requests:
+            try:
+                geom.reply()
+                pos.reply()
+                wmclass, netname, name, desktop, extents, wintype, state, pid, hints = [ self.property_value( r ) for r in values ]
+            except Xlib.error.XError:
+                continue # window was destroyed in the meantime
+
+            left, right, top, bottom = extents if ( extents and len( extents ) == 4 ) else ( 0, 0, 0, 0 )
+            title = netname if netname is not None else name
+            if ( isinstance( title, bytes ) ):
+                title = title.decode( 'utf-8', 'replace' )
+
+            window = self.display.create_resource_object( 'window', wid )
+            clients.append( Bunch( id = wid, window = window,
+                                   x = pos.x - left, y = pos.y - top,
+                                   width = geom.width + left + right, height = geom.height + top + bottom,
+                                   extents = ( left, right, top, bottom ),
+                                   desktop = desktop[0] if desktop else None,
+                                   wmclass = wmclass,
+                                   title = title or "",
+                                   type = list( wintype ) if wintype else [],
+                                   state = list( state ) if state else [],
+                                   pid = pid[0] if pid else None,
+                                   hints = hints ) )
+        return clients
+
+
+    @staticmethod
+    def property_value( reply ):
+        '''value from a GetProperty reply, or None if the property isn't set.  Raises the X error if the request failed.'''
+        reply.reply()
+        if ( not reply.property_type ):
+            return None
+        fmt, value = reply.value
+        return value
+
+
+    def send_event( self, win, ctype, data, mask=None, flush=True ):
         """ Send a ClientMessage event to the root window """
         data = (data+[0]*(5-len(data)))[:5]
         ev = Xlib.protocol.event.ClientMessage(window=win, client_type=ctype, data=(32,(data)))
@@ -251,7 +705,8 @@ class Screen:
             mask = (Xlib.X.SubstructureRedirectMask|Xlib.X.SubstructureNotifyMask)
 
         self.root.send_event(ev, event_mask=mask)
-        self.display.flush()
+        if flush:
+            self.display.flush()
 
 
         
@@ -314,50 +769,29 @@ class KeyEvent:
         logger.debug("event.type: %s | event.detail: %s | event.state: %s | event.root_x %s | event.root_y %s | self.modnone: %s | self.modalt: %s | self.modshift: %s | self.modcontrol: %s | self.modsuper: %s" % ( self.event.type, self.event.detail, format(self.event.state, '08b'), self.event.root_x, self.event.root_y, self.modnone, self.modalt, self.modshift, self.modcontrol, self.modsuper ) )
         
     def get_action( self ):
-        '''Determine if key event is an action hotkey'''
-        
-        if ( self.is_keypress and self.keycode == self.parent.trigger_keycode and self.parent.isActive == False ):
-            self.action = "trigger_press";
+        '''Determine if key event is an action hotkey.  Sets self.action to the action name (False if there isn't one), and self.handler.'''
+        self.handler = None
         
-        elif ( self.is_keyrelease and self.keycode == self.parent.trigger_keycode and self.parent.isActive == True ):
-            self.action = "trigger_release"
-        
-        elif ( self.is_keypress == False ) or ( self.parent.isActive == False ) :
+        if ( self.keycode == self.parent.trigger_keycode ):
+            if ( self.is_keypress and self.parent.isActive == False ):
+                self.action = "trigger_press"
+            elif ( self.is_keyrelease and self.parent.isActive == True ):
+                self.action = "trigger_release"
+            else:
+                self.action = False
+            return self.action
+
+        if ( self.is_keypress == False ) or ( self.parent.isActive == False ) :
             # None of the remaining hotkeys have these properties, so exit.
             self.action = False
             return False
-        
-        elif ( self.keycode == self.parent.conf.get("MONITORS", "Mon0_Hotkey") ):
-            self.action = "set_monitor_0"
 
-        elif ( self.keycode == self.parent.conf.get("MONITORS", "Mon1_Hotkey") ):
-            self.action = "set_monitor_1"
-
-        elif ( self.keycode == self.parent.conf.get("MONITORS", "Mon2_Hotkey") ):
-            self.action = "set_monitor_2"
-
-        elif ( self.keycode == self.parent.conf.get("MONITORS", "Mon3_Hotkey") ):
-            self.action = "set_monitor_3"
-        
-        elif ( ( self.modnone or self.modonly("shift") ) and self.keycode in self.parent.tilekeymap and self.parent.activeWindow != self.parent.root and ( str(self.parent.activeWindow.info['WM_NAME']).lower() !=  "desktop" ) ):
-            self.action = "tilekey"
-            
-        elif ( self.keycode in self.parent.desktopkeymap ):
-            self.action = "desktopkey"
-            
-        elif ( self.modnone and self.keycode in self.parent.cursorkeys and self.parent.valid_window() ):
-            self.action = "movewin"
-            
-        elif ( self.modonly("shift") and self.keycode in self.parent.cursorkeys and self.parent.valid_window() ):
-            self.action = "sizewin_tl"
-            
-        elif ( self.modonly("control") and self.keycode in self.parent.cursorkeys and self.parent.valid_window() ):
-            self.action = "sizewin_br"
-            
-        else:
+        entry = self.parent.dispatch.get( ( self.keycode, self.event.state & self.parent.modmask ) )
+        if ( entry is None ) or ( entry.predicate and not entry.predicate() ):
             self.action = False
+        else:
+            self.action = entry.action
+            self.handler = entry.handler
         
         return self.action
 
-
-    